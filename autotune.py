@@ -0,0 +1,169 @@
+"""
+measure training (or decoding) speed of a config's model under a few config['runtime'] thread
+settings (see runtime.py), each in a fresh process, and record the fastest
+
+    python autotune.py --config sample_config.json [--objective train] [--batches 20]
+
+the measurements and the best setting go to working_dir/autotune.json: copy its "best" into the
+config's "runtime" section to use it. the config's pin_cores (if any) is kept for every setting
+"""
+import json
+import logging
+import argparse
+import os
+import time
+import queue
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+import data
+import models
+import evaluation
+import runtime
+from train import build_model, build_optimizer, get_batch_loader
+from cuda import CUDA
+
+
+# batches run before the clock starts (allocations, lazy init)
+WARMUP_BATCHES = 2
+
+
+def candidate_settings(max_threads):
+    """ intra-op threads in powers of two up to max_threads, each with the blas on one thread or as many """
+    threads = sorted(set([2 ** i for i in range(int(np.log2(max_threads)) + 1)] + [max_threads]))
+    candidates = []
+    for num_threads in threads:
+        for blas_threads in sorted(set([1, num_threads])):
+            candidates.append({'intra_op_threads': num_threads, 'inter_op_threads': 1, 'blas_threads': blas_threads})
+    return candidates
+
+
+def train_speed(model, src, config, num_batches):
+    """ source tokens per second of num_batches training steps, batch building included """
+    weight_mask = torch.ones(len(src['tok2id']))
+    weight_mask[src['tok2id']['<pad>']] = 0
+    loss_criterion = models.SequenceLoss(weight=weight_mask, output_projection=model.output_projection)
+    if CUDA:
+        loss_criterion = loss_criterion.cuda()
+    optimizer = build_optimizer(model, config)
+
+    model.train()
+    tokens = 0
+    start = time.time()
+    for batch_idx, (input_content, input_aux, output) in enumerate(get_batch_loader(src, config, 0)):
+        input_content_src, _, srclens, srcmask, _ = input_content
+        input_ids_aux, _, auxlens, auxmask, _ = input_aux
+        input_data_tgt, output_data_tgt, _, _, _ = output
+
+        decoder_logit, decoder_mixture = model(input_content_src, srcmask, srclens,
+                                               input_ids_aux, auxmask, auxlens, input_data_tgt, mode='train',
+                                               return_probs=False)
+        optimizer.zero_grad()
+        loss = loss_criterion(decoder_logit, decoder_mixture, output_data_tgt)
+        loss.backward()
+        _ = nn.utils.clip_grad_norm_(model.parameters(), config['training']['max_norm'])
+        optimizer.step()
+
+        tokens += int(np.sum(srclens))
+        if batch_idx == WARMUP_BATCHES - 1:
+            tokens = 0
+            start = time.time()
+        if batch_idx == WARMUP_BATCHES + num_batches - 1:
+            break
+    return tokens / (time.time() - start)
+
+
+def decode_speed(model, src_dev, tgt_dev, config, num_batches):
+    """ source tokens per second of decoding num_batches dev batches, as the dev evaluation does """
+    batch_size = evaluation.get_decode_batch_size(config)
+    indices = list(range(min(num_batches * batch_size, len(src_dev['data']))))
+    evaluation.decode_dev(model, src_dev, tgt_dev, config, indices=indices[:batch_size * WARMUP_BATCHES])
+
+    lengths = data.line_lengths(src_dev['data'])
+    tokens = sum(min(lengths[i], config['data']['max_len']) for i in indices)
+    start = time.time()
+    evaluation.decode_dev(model, src_dev, tgt_dev, config, indices=indices)
+    return tokens / (time.time() - start)
+
+
+def measure_worker(config, objective, num_batches, results):
+    """ process measuring one setting: puts (settings in effect, tokens per second) on results """
+    settings = runtime.apply_runtime(config)
+    src, tok_weights_dict = data.gen_train_data(src=config['data']['src'], tgt=config['data']['tgt'], config=config)
+    model = build_model(src, config)
+    if CUDA:
+        model = model.cuda()
+
+    if objective == 'train':
+        speed = train_speed(model, src, config, num_batches)
+    elif objective == 'decode':
+        src_dev, tgt_dev = data.gen_dev_data(src=config['data']['src_dev'], tgt=config['data']['tgt_dev'],
+                                             tok_weights_dict=tok_weights_dict, config=config)
+        speed = decode_speed(model, src_dev, tgt_dev, config, num_batches)
+    else:
+        raise NotImplementedError("unknown autotune objective")
+    results.put((settings, speed))
+
+
+def autotune(config, working_dir, objective='train', num_batches=20, max_threads=None):
+    """ measure every candidate_settings() and write them with the best to working_dir/autotune.json """
+    base = runtime.get_runtime(config)
+    if max_threads is None:
+        pinned = base['pin_cores']
+        max_threads = len(pinned) if pinned is not None else len(runtime.available_cores())
+
+    # read the data once so every measuring process finds it in the artifact cache
+    data.gen_train_data(src=config['data']['src'], tgt=config['data']['tgt'], config=config)
+
+    # a fresh process per setting: inter-op threads can only be set once, and blas pools keep their threads
+    ctx = mp.get_context('spawn')
+    measurements = []
+    for candidate in candidate_settings(max_threads):
+        results = ctx.Queue()
+        process = ctx.Process(target=measure_worker,
+                              args=(dict(config, runtime=dict(base, **candidate)), objective, num_batches, results))
+        process.start()
+        while True:
+            try:
+                settings, speed = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError('autotune process exited with code %s' % process.exitcode)
+        process.join()
+        logging.info('%s: %.1f tokens/sec' % (settings, speed))
+        measurements.append({'runtime': settings, 'tokens_per_sec': speed})
+
+    best = max(measurements, key=lambda x: x['tokens_per_sec'])
+    logging.info('BEST (%s): %s %.1f tokens/sec' % (objective, best['runtime'], best['tokens_per_sec']))
+    with open(os.path.join(working_dir, 'autotune.json'), 'w') as f:
+        json.dump({'objective': objective, 'best': best['runtime'], 'measurements': measurements}, f, indent=2)
+    return best
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="path to json config", required=True)
+    parser.add_argument("--objective", help="what to speed up", choices=['train', 'decode'], default='train')
+    parser.add_argument("--batches", help="batches timed per setting", type=int, default=20)
+    parser.add_argument("--max_threads", help="most threads tried (default: the available cores)", type=int)
+
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+
+    working_dir = config['data']['working_dir']
+    if not os.path.exists(working_dir):
+        os.makedirs(working_dir)
+
+    # set up logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename='%s/autotune_log' % working_dir)
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger('').addHandler(console)
+
+    autotune(config, working_dir, args.objective, args.batches, args.max_threads)
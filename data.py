@@ -1,7 +1,12 @@
 """Data utilities."""
 import os
 import random
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.sparse
 from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 
 import torch
@@ -14,7 +19,9 @@ from gensim.models.doc2vec import Doc2Vec, TaggedDocument
 from tools.make_attribute_vocab import make_attribute
 
 class CorpusSearcher(object):
-    def __init__(self, query_corpus, key_corpus, value_corpus, vectorizer, make_binary=True, use_doc2vec=False):
+    def __init__(self, query_corpus, key_corpus, value_corpus, vectorizer, make_binary=True, use_doc2vec=False,
+                 key_corpus_matrix=None):
+        """ key_corpus_matrix: previously computed (e.g. cached) matrix of key_corpus, skips vectorizing it """
         self.use_doc2vec = use_doc2vec
 
         if(use_doc2vec):
@@ -32,6 +39,11 @@ class CorpusSearcher(object):
                 key_corpus_matrix.append(np.array(self.vectorizer.docvecs[str(i)]))
             self.key_corpus_matrix = np.array(key_corpus_matrix)
             
+        elif key_corpus_matrix is not None:
+            # a fixed-vocabulary vectorizer can transform queries without being fit
+            self.vectorizer = vectorizer
+            self.key_corpus_matrix = key_corpus_matrix
+
         else:
             self.vectorizer = vectorizer
             self.vectorizer.fit(key_corpus)
@@ -43,47 +55,137 @@ class CorpusSearcher(object):
         self.query_corpus = query_corpus
         self.key_corpus = key_corpus
         self.value_corpus = value_corpus
+        # optional [num_queries, k] table of precomputed most_similar() indices
+        self.neighbours = None
         
     def most_similar(self, key_idx, n=10):
-        query = self.query_corpus[key_idx]
+        return self.most_similar_batch([key_idx], n)[0]
 
-        if(self.use_doc2vec):
-            query_vec = query.split()
-            
-            topn_vec = self.vectorizer.docvecs.most_similar([self.vectorizer.infer_vector(query_vec)], topn=n)
+    def most_similar_batch(self, key_indices, n=10):
+        """
+        retrieve the n most similar examples for every query in key_indices
 
-            # Convert tag to integer
-            selected = []
-            for (str_i, score) in topn_vec:
-                i = int(str_i)
-                selected.append((self.query_corpus[i], ' '.join(self.key_corpus[i]), self.value_corpus[i], i, score) )
+        returns one list per query of (query, key, value, i, score) tuples, best first
+        """
+        return self.most_similar_queries([self.query_corpus[key_idx] for key_idx in key_indices], n)
 
-        else:
-            query_vec = self.vectorizer.transform([query])
-            scores = np.dot(self.key_corpus_matrix, query_vec.T)
-            scores = np.squeeze(scores.toarray()) 
-        
-            scores_indices = zip(scores, range(len(scores)))
-            selected = sorted(scores_indices, reverse=True)[:n]
+    def most_similar_queries(self, queries, n=10):
+        """ most_similar_batch() for query strings that need not be in query_corpus (e.g. new inputs) """
+        if(self.use_doc2vec):
+            selected_batch = []
+            for query in queries:
+                query_vec = query.split()
+                
+                topn_vec = self.vectorizer.docvecs.most_similar([self.vectorizer.infer_vector(query_vec)], topn=n)
+
+                # Convert tag to integer
+                selected = []
+                for (str_i, score) in topn_vec:
+                    i = int(str_i)
+                    selected.append((self.query_corpus[i], ' '.join(self.key_corpus[i]), self.value_corpus[i], i, score) )
+                selected_batch.append(selected)
+            return selected_batch
+
+        # one sparse-sparse product for the whole block of queries
+        query_vecs = self.vectorizer.transform(queries)
+        # [num_queries, num_keys]
+        scores = query_vecs.dot(self.key_corpus_matrix.T).toarray()
+
+        selected_batch = []
+        for row in scores:
             # use the retrieved i to pick examples from the VALUE corpus
-            selected = [
-                (self.query_corpus[i], self.key_corpus[i], self.value_corpus[i], i, score) 
-                for (score, i) in selected
-            ]
-    
-        #print("\n\nQuery: " + query)
-        #print("\n\tSelected: ")
-        #for select in selected:
-        #    print("\ti: " + str(select[3]) + "\tkey_corpus[i]: " + str(select[1]) + "\tvalue_corpus[i]: " + str(select[2]) + "\tscore: " + str(select[4]))
-        #return []
-        #if(self.use_doc2vec):
-        #    print("\n\nQuery: " + query)
-        #    print("\n\tSelected: ")
-        #    for select in selected:
-        #        print("\ti: " + str(select[3]) + "\tkey_corpus[i]: " + str(select[1]) + "\tvalue_corpus[i]: " + str(select[2]) + "\tscore: " + str(select[4]))
-        #return
+            selected_batch.append([
+                (self.query_corpus[i], self.key_corpus[i], self.value_corpus[i], i, row[i])
+                for i in top_n_indices(row, n)
+            ])
+        return selected_batch
+
+
+    def build_neighbour_table(self, k, num_workers=None, cache_dir=None, cache_name=None):
+        """
+        precompute the indices of the k most similar examples of every query as a compact 
+        [num_queries, k] int32 table (padded with -1 if there are fewer than k keys), 
+        scoring the queries in chunks spread over num_workers processes (default: all cores).
+        
+        the table is reused from the artifact cache (cache_dir, see load_cache()) under cache_name 
+        if it is there, and saved to it otherwise
+        """
+        cached = load_cache(cache_dir, cache_name)
+        if cached is not None and cached['neighbours'].shape == (len(self.query_corpus), k):
+            self.neighbours = cached['neighbours']
+            return self.neighbours
+
+        num_queries = len(self.query_corpus)
+        # keep each chunk's dense [chunk_size, num_keys] score matrix small
+        chunk_size = max(1, NEIGHBOUR_CHUNK_ELEMENTS // max(1, len(self.key_corpus)))
+        chunks = [(start, min(start + chunk_size, num_queries), k) for start in range(0, num_queries, chunk_size)]
+        num_workers = num_workers or multiprocessing.cpu_count()
+
+        if num_workers > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(min(num_workers, len(chunks)), 
+                                        initializer=init_neighbour_worker, initargs=(self,))
+            try:
+                tables = pool.map(neighbour_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_neighbour_worker(self)
+            tables = [neighbour_chunk(chunk) for chunk in chunks]
+
+        table = np.concatenate(tables) if tables else np.zeros((0, k), dtype=np.int32)
+        save_cache(cache_dir, cache_name, {'neighbours': table})
+        self.neighbours = table
+        return table
+
+
+# number of dense scores each neighbour table chunk may hold (~32MB of int64)
+NEIGHBOUR_CHUNK_ELEMENTS = 2 ** 22
+
+# searcher used by the neighbour table worker processes
+_neighbour_searcher = None
+
 
-        return selected
+def init_neighbour_worker(searcher):
+    global _neighbour_searcher
+    _neighbour_searcher = searcher
+
+
+def neighbour_chunk(chunk):
+    """ [end - start, k] table rows of the queries start..end """
+    start, end, k = chunk
+    table = np.full((end - start, k), -1, dtype=np.int32)
+    for row, selected in enumerate(_neighbour_searcher.most_similar_batch(range(start, end), k)):
+        table[row, :len(selected)] = [i for _, _, _, i, _ in selected]
+    return table
+
+
+def file_digest(paths):
+    """ short md5 digest of the contents of the given files, to name derived caches """
+    md5 = hashlib.md5()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+    return md5.hexdigest()[:12]
+
+
+def top_n_indices(scores, n):
+    """
+    indices of the n highest scores, ordered like sorted(zip(scores, range(len(scores))), reverse=True)[:n]
+    (i.e. by descending score, ties going to the higher index) without sorting the whole array
+    """
+    n = min(n, len(scores))
+    if n == 0:
+        return []
+    # partial selection: the n-th highest score splits the candidates from the rest
+    kth_score = scores[np.argpartition(-scores, n - 1)[n - 1]]
+    above = np.flatnonzero(scores > kth_score)
+    ties = np.flatnonzero(scores == kth_score)[::-1][:n - len(above)]
+    candidates = np.concatenate((above, ties))
+    # descending score, then descending index
+    order = np.lexsort((-candidates, -scores[candidates]))
+    return candidates[order]
 
 
 def build_vocab_maps(vocab_file):
@@ -129,13 +231,125 @@ def extract_attributes(line, tok_weights_dict):
     return line, content, attribute
 
 
-def gen_train_data(src, tgt, config):
-    tok_weights_dict = make_attribute(src, tgt)
+# bump when the layout of the cached artifacts changes
+CACHE_VERSION = 1
+
+
+def get_cache_dir(config):
+    """ directory of the on-disk artifact cache (None if config['data']['artifact_cache'] is off) """
+    if not config['data'].get('artifact_cache', False):
+        return None
+    cache_dir = os.path.join(config['data']['working_dir'], 'cache')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def weights_digest(tok_weights_dict):
+    """ short md5 digest of a token weight dict """
+    return hashlib.md5(repr(sorted(tok_weights_dict.items())).encode('utf8')).hexdigest()[:12]
+
 
-    src_lines = [l.strip().split() for l in open(src, 'r', encoding="utf8")]
-    src_lines, src_content, src_attribute = list(zip(
-        *[extract_attributes(line, tok_weights_dict) for line in src_lines]
+def load_cache(cache_dir, name):
+    """ the arrays stored under name, or None on a cache miss """
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, name + '.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        return dict(cached.items())
+
+
+def save_cache(cache_dir, name, arrays):
+    if cache_dir is None:
+        return
+    path = os.path.join(cache_dir, name + '.npz')
+    # write then rename, so concurrent runs never see a partial file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, path)
+
+
+def pack_token_lists(token_lists):
+    """ list of token lists -> utf8 bytes (one space separated line per list) as a uint8 array """
+    text = '\n'.join(' '.join(tokens) for tokens in token_lists)
+    return np.frombuffer(text.encode('utf8'), dtype=np.uint8)
+
+
+def unpack_token_lists(packed, num_lines):
+    if num_lines == 0:
+        return []
+    return [line.split() for line in packed.tobytes().decode('utf8').split('\n')]
+
+
+def pack_matrix(prefix, matrix):
+    matrix = matrix.tocsr()
+    return {
+        prefix + '_data': matrix.data, prefix + '_indices': matrix.indices,
+        prefix + '_indptr': matrix.indptr, prefix + '_shape': np.array(matrix.shape)
+    }
+
+
+def unpack_matrix(prefix, arrays):
+    return scipy.sparse.csr_matrix(
+        (arrays[prefix + '_data'], arrays[prefix + '_indices'], arrays[prefix + '_indptr']),
+        shape=tuple(arrays[prefix + '_shape']))
+
+
+def pack_split(prefix, lines, content, attribute):
+    return {
+        prefix + '_num_lines': np.array(len(lines)),
+        prefix + '_lines': pack_token_lists(lines),
+        prefix + '_content': pack_token_lists(content),
+        prefix + '_attribute': pack_token_lists(attribute),
+    }
+
+
+def unpack_split(prefix, arrays):
+    num_lines = int(arrays[prefix + '_num_lines'])
+    return tuple(
+        tuple(unpack_token_lists(arrays[prefix + '_' + part], num_lines))
+        for part in ('lines', 'content', 'attribute')
+    )
+
+
+def split_attributes(path, tok_weights_dict):
+    """ (lines, content, attribute) of every line in path """
+    lines = [l.strip().split() for l in open(path, 'r', encoding="utf8")]
+    return tuple(zip(
+        *[extract_attributes(line, tok_weights_dict) for line in lines]
     ))
+
+
+def cached_make_attribute(src, tgt, cache_dir):
+    """ make_attribute(src, tgt), cached on the contents of src and tgt """
+    name = 'tok_weights.v%d.%s' % (CACHE_VERSION, file_digest([src, tgt]))
+    cached = load_cache(cache_dir, name)
+    if cached is not None:
+        toks = cached['toks'].tobytes().decode('utf8').split('\n') if len(cached['toks']) else []
+        return dict(zip(toks, cached['weights'].tolist()))
+
+    tok_weights_dict = make_attribute(src, tgt)
+    save_cache(cache_dir, name, {
+        'toks': np.frombuffer('\n'.join(tok_weights_dict).encode('utf8'), dtype=np.uint8),
+        'weights': np.array(list(tok_weights_dict.values()), dtype=np.float64),
+    })
+    return tok_weights_dict
+
+
+def gen_train_data(src, tgt, config):
+    cache_dir = get_cache_dir(config)
+    tok_weights_dict = cached_make_attribute(src, tgt, cache_dir)
+
+    # tok_weights_dict is a function of src and tgt, so they key the split too
+    cache_name = 'train.v%d.%s' % (CACHE_VERSION, file_digest([src, tgt, config['data']['src_vocab']]))
+    cached = load_cache(cache_dir, cache_name)
+    if cached is not None:
+        src_lines, src_content, src_attribute = unpack_split('src', cached)
+    else:
+        src_lines, src_content, src_attribute = split_attributes(src, tok_weights_dict)
     src_tok2id, src_id2tok = build_vocab_maps(config['data']['src_vocab'])
     # train time: just pick attributes that are close to the current (using word distance)
     # we never need to do the TFIDF thing with the source because 
@@ -145,21 +359,57 @@ def gen_train_data(src, tgt, config):
         key_corpus=[' '.join(x) for x in src_attribute],
         value_corpus=[' '.join(x) for x in src_attribute],
         vectorizer=CountVectorizer(vocabulary=src_tok2id),
-        make_binary=True
+        make_binary=True,
+        key_corpus_matrix=unpack_matrix('src_matrix', cached) if cached is not None else None
     )
+    if cached is None:
+        arrays = pack_split('src', src_lines, src_content, src_attribute)
+        arrays.update(pack_matrix('src_matrix', src_dist_measurer.key_corpus_matrix))
+        save_cache(cache_dir, cache_name, arrays)
+
+    # sample_replace() looks up the same neighbours every epoch, so compute them once
+    neighbour_k = config['data'].get('neighbour_k', 0)
+    if neighbour_k > 0:
+        src_dist_measurer.build_neighbour_table(neighbour_k, config['data'].get('neighbour_workers'), cache_dir=cache_dir,
+                                                cache_name='%s.neighbours.%d' % (cache_name, neighbour_k))
     src = {
         'data': src_lines, 'content': src_content, 'attribute': src_attribute,
         'tok2id': src_tok2id, 'id2tok': src_id2tok, 'dist_measurer': src_dist_measurer
     }
+    if config['data'].get('id_corpus', False):
+        convert_to_id_corpus(src, config['data']['src_vocab'], cache_dir, cache_name + '.src')
 
     return src, tok_weights_dict
 
 
+def attribute_vocab(tok_weights_dict, config):
+    """ 
+    the attribute words: those of config['data']['attribute_vocab'] (one per line, as written by 
+    tools/make_attribute_vocab.py) if that file exists, otherwise the attribute_vocab_size (default 1000, 
+    as in the tool) highest weighted words of the training data's tok_weights_dict
+    """
+    path = config['data'].get('attribute_vocab')
+    if path and os.path.exists(path):
+        with open(path, encoding='utf8') as f:
+            return [line.strip() for line in f if line.strip()]
+    size = config['data'].get('attribute_vocab_size', 1000)
+    return sorted(tok_weights_dict, key=lambda k: tok_weights_dict[k], reverse=True)[:size]
+
+
 def gen_dev_data(src, tgt, tok_weights_dict, config):
-    src_lines = [l.strip().split() for l in open(src, 'r', encoding="utf8")]
-    src_lines, src_content, src_attribute = list(zip(
-        *[extract_attributes(line, tok_weights_dict) for line in src_lines]
-    ))
+    cache_dir = get_cache_dir(config)
+    # the tgt IdCorpus (cache_name + '.tgt') holds ids of tgt_vocab
+    cache_name = 'dev.v%d.%s.%s' % (CACHE_VERSION,
+                                    file_digest([src, tgt, config['data']['src_vocab'], config['data']['tgt_vocab']]),
+                                    weights_digest(tok_weights_dict))
+    cached = load_cache(cache_dir, cache_name)
+    if cached is not None:
+        src_lines, src_content, src_attribute = unpack_split('src', cached)
+        tgt_lines, tgt_content, tgt_attribute = unpack_split('tgt', cached)
+    else:
+        src_lines, src_content, src_attribute = split_attributes(src, tok_weights_dict)
+        tgt_lines, tgt_content, tgt_attribute = split_attributes(tgt, tok_weights_dict)
+
     src_tok2id, src_id2tok = build_vocab_maps(config['data']['src_vocab'])
     # train time: just pick attributes that are close to the current (using word distance)
     # we never need to do the TFIDF thing with the source because 
@@ -169,45 +419,84 @@ def gen_dev_data(src, tgt, tok_weights_dict, config):
         key_corpus=[' '.join(x) for x in src_attribute],
         value_corpus=[' '.join(x) for x in src_attribute],
         vectorizer=CountVectorizer(vocabulary=src_tok2id),
-        make_binary=True
+        make_binary=True,
+        key_corpus_matrix=unpack_matrix('src_matrix', cached) if cached is not None else None
     )
     src = {
         'data': src_lines, 'content': src_content, 'attribute': src_attribute,
         'tok2id': src_tok2id, 'id2tok': src_id2tok, 'dist_measurer': src_dist_measurer
     }
 
-    tgt_lines = [l.strip().split() for l in open(tgt, 'r', encoding="utf8")] if tgt else None
-    tgt_lines, tgt_content, tgt_attribute = list(zip(
-        *[extract_attributes(line, tok_weights_dict) for line in tgt_lines]
-    ))
     tgt_tok2id, tgt_id2tok = build_vocab_maps(config['data']['tgt_vocab'])
     tgt_dist_measurer = CorpusSearcher(
         query_corpus=[' '.join(x) for x in src_content],
         key_corpus=[' '.join(x) for x in tgt_content],
         value_corpus=[' '.join(x) for x in tgt_attribute],
         vectorizer=CountVectorizer(vocabulary=src_tok2id),
-        make_binary=True
+        make_binary=True,
+        key_corpus_matrix=unpack_matrix('tgt_matrix', cached) if cached is not None else None
     )
     tgt = {
         'data': tgt_lines, 'content': tgt_content, 'attribute': tgt_attribute,
-        'tok2id': tgt_tok2id, 'id2tok': tgt_id2tok, 'dist_measurer': tgt_dist_measurer
+        'tok2id': tgt_tok2id, 'id2tok': tgt_id2tok, 'dist_measurer': tgt_dist_measurer,
+        # from the training data, unlike 'attribute' (see evaluation.get_shortlist_base())
+        'attribute_vocab': attribute_vocab(tok_weights_dict, config)
     }
 
+    if cached is None:
+        arrays = pack_split('src', src_lines, src_content, src_attribute)
+        arrays.update(pack_split('tgt', tgt_lines, tgt_content, tgt_attribute))
+        arrays.update(pack_matrix('src_matrix', src_dist_measurer.key_corpus_matrix))
+        arrays.update(pack_matrix('tgt_matrix', tgt_dist_measurer.key_corpus_matrix))
+        save_cache(cache_dir, cache_name, arrays)
+
+    if config['data'].get('id_corpus', False):
+        convert_to_id_corpus(src, config['data']['src_vocab'], cache_dir, cache_name + '.src')
+        convert_to_id_corpus(tgt, config['data']['tgt_vocab'], cache_dir, cache_name + '.tgt')
+
     return src, tgt
 
 
-def sample_replace(lines, dist_measurer, sample_rate, corpus_idx):
+def batch_indices(index, batch_size, num_lines):
+    """ corpus indices of a batch given either by its start index or as an explicit list of indices """
+    if isinstance(index, (list, tuple, np.ndarray)):
+        return list(index)
+    return list(range(index, min(index + batch_size, num_lines)))
+
+
+def sample_replace(lines, dist_measurer, sample_rate, corpus_idx, rng=random):
     """
     replace sample_rate * batch_size lines with nearby examples (according to dist_measurer)
     not exactly the same as the paper (words shared instead of jaccaurd during train) but same idea
+
+    corpus_idx is the corpus index of the first line, or a list with the corpus index of every line,
+    rng the random.Random (or the random module) that decides which lines get replaced
     """
+    if isinstance(corpus_idx, (list, tuple, np.ndarray)):
+        line_indices = list(corpus_idx)
+    else:
+        line_indices = [corpus_idx + i for i in range(len(lines))]
     out = [None for _ in range(len(lines))]
+    replaced = [i for i in range(len(lines)) if rng.random() < sample_rate]
+    if dist_measurer.neighbours is not None:
+        # precomputed most_similar() indices
+        replaced_attrs = [
+            [dist_measurer.value_corpus[j] for j in dist_measurer.neighbours[line_indices[i]] if j >= 0]
+            for i in replaced
+        ]
+    else:
+        replaced_sims = dist_measurer.most_similar_batch([line_indices[i] for i in replaced]) if replaced else []
+        replaced_attrs = [
+            [tgt_attr for src_cntnt, tgt_cntnt, tgt_attr, _, _ in sims]
+            for sims in replaced_sims
+        ]
+    replaced_attrs = dict(zip(replaced, replaced_attrs))
     for i, line in enumerate(lines):
-        if random.random() < sample_rate:
-            sims = dist_measurer.most_similar(corpus_idx + i)[1:]  # top match is the current line
+        if i in replaced_attrs:
+            sims = replaced_attrs[i][1:]  # top match is the current line
             try:
                 line = next( (
-                    tgt_attr.split() for src_cntnt, tgt_cntnt, tgt_attr, _, _ in sims
+                    tgt_attr.split() for tgt_attr in sims
                     if tgt_attr != ' '.join(line) # and tgt_attr != ''   # TODO -- exclude blanks?
                 ) )
             # all the matches are blanks
@@ -223,20 +512,165 @@ def sample_replace(lines, dist_measurer, sample_rate, corpus_idx):
     return out
 
 
+class IdCorpus(object):
+    """
+    pre-tokenised corpus: one flat int32 array of token ids plus an int64 offsets array, 
+    line i being tokens[offsets[i]:offsets[i + 1]]. the arrays are usually memory-mapped .npy files.
+    
+    indexing it gives back token lists, so it can stand in for the list of token lists it was built from
+    """
+    def __init__(self, tokens, offsets, id2tok):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.id2tok = id2tok
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, i):
+        """ token ids of line i """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return [self.id2tok[tok] for tok in self.row(i)]
+
+
+def build_id_corpus(token_lists, tok2id, id2tok, cache_dir=None, name=None):
+    """
+    convert token lists to an IdCorpus (unknown words -> <unk>), memory-mapped from
+    cache_dir/name.{tokens,offsets}.npy, which are written on the first call
+    """
+    if cache_dir is not None:
+        tokens_path = os.path.join(cache_dir, name + '.tokens.npy')
+        offsets_path = os.path.join(cache_dir, name + '.offsets.npy')
+        if os.path.exists(tokens_path) and os.path.exists(offsets_path):
+            return IdCorpus(np.load(tokens_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r'), id2tok)
+
+    unk_id = tok2id['<unk>']
+    offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(line) for line in token_lists])
+    tokens = np.array([tok2id.get(w, unk_id) for line in token_lists for w in line], dtype=np.int32)
+
+    if cache_dir is None:
+        return IdCorpus(tokens, offsets, id2tok)
+    for path, arr in ((tokens_path, tokens), (offsets_path, offsets)):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+        os.rename(tmp_path, path)
+    return IdCorpus(np.load(tokens_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r'), id2tok)
+
+
+def convert_to_id_corpus(dataset, vocab_file, cache_dir, name):
+    """ swap the 'data', 'content' and 'attribute' token lists of dataset for IdCorpus objects """
+    name = '%s.%s' % (name, file_digest([vocab_file]))
+    for part in ('data', 'content', 'attribute'):
+        dataset[part] = build_id_corpus(dataset[part], dataset['tok2id'], dataset['id2tok'],
+                                        cache_dir, '%s.%s' % (name, part))
+
+
+def sample_replace_ids(starts, lengths, corpus, dist_measurer, sample_rate, line_indices, sos_id, eos_id,
+                       rng=random):
+    """
+    sample_replace() for an IdCorpus batch given as (starts, lengths) spans of corpus.tokens, 
+    line_indices being the corpus index of every line; the spans of the replaced lines are 
+    pointed at their retrieved neighbours in place
+    """
+    replaced = [i for i in range(len(starts)) if rng.random() < sample_rate]
+    if dist_measurer.neighbours is not None:
+        # precomputed most_similar() indices
+        replaced_sims = [[j for j in dist_measurer.neighbours[line_indices[i]] if j >= 0] for i in replaced]
+    else:
+        replaced_sims = dist_measurer.most_similar_batch([line_indices[i] for i in replaced]) if replaced else []
+        replaced_sims = [[j for _, _, _, j, _ in sims] for sims in replaced_sims]
+
+    # the value corpus of dist_measurer is the corpus being batched, so value j is corpus row j
+    for i, sims in zip(replaced, replaced_sims):
+        line = np.concatenate(([sos_id], corpus.tokens[starts[i]:starts[i] + lengths[i]], [eos_id]))
+        # top match is the current line
+        j = next((j for j in sims[1:] if not np.array_equal(corpus.row(j), line)), None)
+        if j is None:
+            # all the matches are blanks
+            lengths[i] = 0
+        else:
+            starts[i] = corpus.offsets[j]
+            lengths[i] = corpus.offsets[j + 1] - corpus.offsets[j]
+
+
+def get_id_minibatch(corpus, tok2id, index, batch_size, max_len, sort=False, idx=None,
+                     dist_measurer=None, sample_rate=0.0, rng=random):
+    """ get_minibatch() for an IdCorpus: gathers the batch straight from the id arrays with numpy """
+    sos_id, eos_id, pad_id = tok2id['<s>'], tok2id['</s>'], tok2id['<pad>']
+    line_indices = np.array(batch_indices(index, batch_size, len(corpus)), dtype=np.int64)
+    # each line is the span tokens[starts[i]:starts[i] + lengths[i]]
+    starts = np.array(corpus.offsets[line_indices], dtype=np.int64)
+    lengths = np.minimum(corpus.offsets[line_indices + 1] - starts, max_len).astype(np.int64)
+    empty = np.zeros(len(starts), dtype=bool)
+    if dist_measurer is not None:
+        sample_replace_ids(starts, lengths, corpus, dist_measurer, sample_rate, line_indices, sos_id, eos_id,
+                           rng=rng)
+        # corner case: special tok for empty sequences (just start/end tok)
+        empty = lengths == 0
+
+    num_lines = len(starts)
+    line_lens = lengths + empty
+    lens = (line_lens + 1).tolist()
+    max_len = max(lens)
+
+    # scatter every token of the batch at once: row i, column col of the flat token list
+    rows = np.repeat(np.arange(num_lines), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    toks = corpus.tokens[np.repeat(starts, lengths) + cols]
+
+    input_lines = np.full((num_lines, max_len), pad_id, dtype=np.int64)
+    input_lines[:, 0] = sos_id
+    input_lines[rows, cols + 1] = toks
+    input_lines[empty, 1] = tok2id['<empty>']
+    output_lines = np.full((num_lines, max_len), pad_id, dtype=np.int64)
+    output_lines[rows, cols] = toks
+    output_lines[empty, 0] = tok2id['<empty>']
+    output_lines[np.arange(num_lines), line_lens] = eos_id
+    mask = (np.arange(max_len)[None, :] < line_lens[:, None] + 1).astype(np.float32)
+
+    if sort:
+        # sort sequence by descending length
+        idx = [x[0] for x in sorted(enumerate(lens), key=lambda x: -x[1])]
+
+    if idx is not None:
+        lens = [lens[j] for j in idx]
+        input_lines = input_lines[idx]
+        output_lines = output_lines[idx]
+        mask = mask[idx]
+
+    input_lines = Variable(torch.from_numpy(input_lines))
+    output_lines = Variable(torch.from_numpy(output_lines))
+    mask = Variable(torch.from_numpy(mask))
+
+    if CUDA:
+        input_lines = input_lines.cuda()
+        output_lines = output_lines.cuda()
+        mask = mask.cuda()
+
+    return input_lines, output_lines, lens, mask, idx
+
+
 def get_minibatch(lines, tok2id, index, batch_size, max_len, sort=False, idx=None,
-                  dist_measurer=None, sample_rate=0.0):
+                  dist_measurer=None, sample_rate=0.0, rng=random):
     """
     Prepare minibatch.
     Input:
         lines: input sequence list
         tok2id: token -> id dictionary
-        index: current batch index
-        batch_size: minibatch size
+        index: current batch index (start of the batch), or a list of the line indices of the batch
+        batch_size: minibatch size (ignored if index is a list)
         max_len: maximum sequence length
         sort: whether to sort sequence by descending length
         idx: the index of the sequence
         dist_measure: replace sample_rate * batch_size lines with nearby examples (don't know which function to use!!)
         sample_rate: sampling rate for the sample_replace() method
+        rng: random source for the sample_replace() method (random.Random or the random module)
     Output:
         input_lines: input sequence_id list (start with <s>), shape = (batch_size, max_len)
         output_lines: input sequence_id list (end with </s>), shape = (batch_size, max_len)
@@ -245,15 +679,20 @@ def get_minibatch(lines, tok2id, index, batch_size, max_len, sort=False, idx=Non
         idx: the index of the sequence
             
     """
+    if isinstance(lines, IdCorpus):
+        return get_id_minibatch(lines, tok2id, index, batch_size, max_len, sort=sort, idx=idx,
+                                dist_measurer=dist_measurer, sample_rate=sample_rate, rng=rng)
+
     # FORCE NO SORTING because we care about the order of outputs
     #   to compare across systems
+    line_indices = batch_indices(index, batch_size, len(lines))
     lines = [
-        ['<s>'] + line[:max_len] + ['</s>']
-        for line in lines[index:index + batch_size]
+        ['<s>'] + lines[i][:max_len] + ['</s>']
+        for i in line_indices
     ]
 
     if dist_measurer is not None:
-        lines = sample_replace(lines, dist_measurer, sample_rate, index)
+        lines = sample_replace(lines, dist_measurer, sample_rate, line_indices, rng=rng)
 
     lens = [len(line) - 1 for line in lines]
     max_len = max(lens)
@@ -298,7 +737,70 @@ def get_minibatch(lines, tok2id, index, batch_size, max_len, sort=False, idx=Non
     return input_lines, output_lines, lens, mask, idx
 
 
-def minibatch(src, tgt, idx, batch_size, max_len, model_type, is_test=False):
+def line_lengths(lines):
+    """ number of tokens of every line of a list of token lists or an IdCorpus """
+    if isinstance(lines, IdCorpus):
+        return np.diff(lines.offsets).tolist()
+    return [len(line) for line in lines]
+
+
+def stratified_sample(lengths, size, rng=random, num_strata=10):
+    """
+    size line indices with the length distribution of all lines: the lines are sorted by length and 
+    cut into num_strata strata of (nearly) equal size, each contributing its share of the sample. 
+    pass a seeded random.Random as rng for a fixed sample. returns the indices in ascending order
+    """
+    num_lines = len(lengths)
+    if size >= num_lines:
+        return list(range(num_lines))
+    order = sorted(range(num_lines), key=lambda i: lengths[i])
+    bounds = [num_lines * k // num_strata for k in range(num_strata + 1)]
+
+    sample = []
+    for k in range(num_strata):
+        stratum = order[bounds[k]:bounds[k + 1]]
+        # shares rounded so they add up to size
+        take = size * bounds[k + 1] // num_lines - size * bounds[k] // num_lines
+        sample += rng.sample(stratum, take)
+    return sorted(sample)
+
+
+def bucket_batches(lengths, batch_size, max_tokens=None, pool_size=100, rng=random):
+    """
+    group line indices into batches of lines with similar lengths, so little of each batch is padding
+    
+    lines are shuffled, cut into pools of pool_size batches and sorted by length within each pool;
+    each pool is then chunked into batches of batch_size lines or, if max_tokens is given, 
+    of as many lines as fit in max_tokens padded tokens. the batches are returned in random order.
+    pass a seeded random.Random as rng for a reproducible order (e.g. one seed per epoch).
+    """
+    indices = list(range(len(lengths)))
+    rng.shuffle(indices)
+
+    batches = []
+    pool_len = batch_size * pool_size
+    for pool_start in range(0, len(indices), pool_len):
+        pool = sorted(indices[pool_start:pool_start + pool_len], key=lambda i: lengths[i])
+        batch, batch_max = [], 0
+        for i in pool:
+            new_max = max(batch_max, lengths[i])
+            if max_tokens:
+                full = new_max * (len(batch) + 1) > max_tokens
+            else:
+                full = len(batch) == batch_size
+            if batch and full:
+                batches.append(batch)
+                batch, new_max = [], lengths[i]
+            batch.append(i)
+            batch_max = new_max
+        if batch:
+            batches.append(batch)
+
+    rng.shuffle(batches)
+    return batches
+
+
+def minibatch(src, tgt, idx, batch_size, max_len, model_type, is_test=False, rng=random):
     """
     Generate minibatch.
     Input:
@@ -309,11 +811,12 @@ def minibatch(src, tgt, idx, batch_size, max_len, model_type, is_test=False):
         tgt:{'data': tgt_lines (target seq list), 'content': tgt_content (target seq list, no attribute words), 
              'attribute': tgt_attribute (list of attributr words, from the dict_att),
              'tok2id': tgt_tok2id, 'id2tok': tgt_id2tok, 'dist_measurer': tgt_dist_measurer}
-        idx: current batch index
-        batch_size: size of the minibatch
+        idx: current batch index (start of the batch), or a list of the line indices of the batch
+        batch_size: size of the minibatch (ignored if idx is a list)
         max_len: maximum sequence length
         model_type: type of models
         is_test: train or test
+        rng: random source (random.Random or the random module), seed one per batch for reproducible batches
     Output:
         inputs: (src_content_lines (with <s>), src_content_lines (with </s>), lens, mask, idx)
         attributes:
@@ -324,7 +827,7 @@ def minibatch(src, tgt, idx, batch_size, max_len, model_type, is_test=False):
             
     """
     if not is_test:
-        use_src = random.random() < 0.5
+        use_src = rng.random() < 0.5
         in_dataset = src if use_src else tgt
         out_dataset = in_dataset
         attribute_id = 0 if use_src else 1
@@ -353,7 +856,7 @@ def minibatch(src, tgt, idx, batch_size, max_len, model_type, is_test=False):
             in_dataset['content'], in_dataset['tok2id'], idx, batch_size, max_len, sort=True)
         attributes = get_minibatch(
             out_dataset['attribute'], out_dataset['tok2id'], idx, batch_size, max_len, idx=inputs[-1],
-            dist_measurer=out_dataset['dist_measurer'], sample_rate=0.25)
+            dist_measurer=out_dataset['dist_measurer'], sample_rate=0.25, rng=rng)
         outputs = get_minibatch(
             out_dataset['data'], out_dataset['tok2id'], idx, batch_size, max_len, idx=inputs[-1])
 
@@ -371,6 +874,50 @@ def minibatch(src, tgt, idx, batch_size, max_len, model_type, is_test=False):
     return inputs, attributes, outputs
 
 
+class BatchPrefetcher(object):
+    """
+    build upcoming minibatches in background threads while the current one is trained on
+    
+    make_batch(batch_idx, batch) is called for every item of batches in num_workers threads, 
+    keeping at most max_prefetch batches in flight; iterating yields the results in order.
+    num_workers=0 builds every batch inline when it is asked for.
+    """
+    def __init__(self, make_batch, batches, num_workers=1, max_prefetch=4):
+        self.make_batch = make_batch
+        self.batches = batches
+        self.num_workers = num_workers
+        self.max_prefetch = max(max_prefetch, num_workers, 1)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for batch_idx, batch in enumerate(self.batches):
+                yield self.make_batch(batch_idx, batch)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        try:
+            pending = deque()
+            todo = iter(enumerate(self.batches))
+            for batch_idx, batch in todo:
+                pending.append(executor.submit(self.make_batch, batch_idx, batch))
+                if len(pending) == self.max_prefetch:
+                    break
+            while pending:
+                result = pending.popleft().result()
+                # keep the queue full before handing the batch over
+                for batch_idx, batch in todo:
+                    pending.append(executor.submit(self.make_batch, batch_idx, batch))
+                    break
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
 def unsort(arr, idx):
     """unsort a list given idx: a list of each element's 'origin' index pre-sorting
     """
@@ -1,5 +1,8 @@
+import functools
+
 import torch
 import torch.nn as nn
+from torch.func import functional_call
 
 
 class BilinearAttention(nn.Module):
@@ -14,15 +17,39 @@ class BilinearAttention(nn.Module):
         self.out_projection = nn.Linear(hidden_dim * 2, hidden_dim, bias=False)
         self.tanh = nn.Tanh()
 
-    def forward(self, query, keys, srcmask=None, values=None):
+    def precompute(self, keys, values=None):
+        """
+            keys: [batch, max_len, hidden_dim]
+            values: [batch, len, hidden_dim] (optional, if none will = keys)
+            
+            move the in_projection onto the keys and the context half of the out_projection onto 
+            the values, once per sentence: score(H_j, q) = (W_a^T H_j)^T q.
+            returns (proj_keys, proj_values), each [batch, len, hidden_dim], for forward(precomputed=...)
+        """
+        if values is None:
+            values = keys
+        hidden_dim = self.in_projection.weight.size(0)
+        # [batch, max_len, hidden_dim]
+        proj_keys = torch.matmul(keys, self.in_projection.weight)
+        # [batch, len, hidden_dim]
+        proj_values = torch.matmul(values, self.out_projection.weight[:, :hidden_dim].t())
+        return proj_keys, proj_values
+
+    def forward(self, query, keys, srcmask=None, values=None, precomputed=None):
         """
             query: [batch, hidden_dim]
             keys: [batch, max_len, hidden_dim]
             values: [batch, len, hidden_dim] (optional, if none will = keys)
+            precomputed: (proj_keys, proj_values) from precompute() (optional), skips the 
+                projections so a step only costs the score and context bmm. 
+                weighted_context is then returned as None.
 
             compare query to keys, use the scores to do weighted sum of values
             if no value is specified, then values = keys
         """
+        if precomputed is not None:
+            return self.forward_precomputed(query, precomputed, srcmask)
+
         if values is None:
             values = keys
     
@@ -46,6 +73,87 @@ class BilinearAttention(nn.Module):
 
         return weighted_context, context_query_mixed, attn_probs
 
+    def forward_precomputed(self, query, precomputed, srcmask=None):
+        proj_keys, proj_values = precomputed
+        hidden_dim = self.in_projection.weight.size(0)
+
+        # [batch, max_len]
+        attn_scores = torch.bmm(proj_keys, query.unsqueeze(2)).squeeze(2)
+        if srcmask is not None:
+            attn_scores = attn_scores.masked_fill(srcmask, -float('inf'))
+
+        attn_probs = self.softmax(attn_scores)
+        # [batch, hidden_dim]: out_projection(cat(context, query)) with the context half already applied
+        projected_context = torch.bmm(attn_probs.unsqueeze(1), proj_values).squeeze(1)
+        context_query_mixed = projected_context + torch.matmul(
+            query, self.out_projection.weight[:, hidden_dim:].t())
+        # [batch, hidden_dim]
+        context_query_mixed = self.tanh(context_query_mixed)
+
+        return None, context_query_mixed, attn_probs
+
+
+@functools.lru_cache(maxsize=None)
+def sequence_lstm(input_size, hidden_size):
+    """ parameterless (meta device) single layer nn.LSTM, run on a cell's weights with functional_call() """
+    return nn.LSTM(input_size, hidden_size, device='meta')
+
+
+class FusedLSTMCell(nn.LSTMCell):
+    """ 
+    lstm cell that can also run a whole sequence in one fused (cuDNN/MKL) lstm call;
+    the parameters are those of nn.LSTMCell, so checkpoints load either way
+    """
+    def forward_sequence(self, input, hidden):
+        """
+            input: [max_len, batch, input_dim]
+            hidden: (h, c) start state, each [batch, hidden_dim]
+            
+            returns the outputs [max_len, batch, hidden_dim] and the final (h, c),
+            same as calling the cell on every timestep
+        """
+        if torch.jit.is_tracing():
+            # functional_call() can't be traced: step the cell (a single step in export.py's predict_step)
+            outputs = []
+            for i in range(input.size(0)):
+                hidden = self(input[i], hidden)
+                outputs.append(hidden[0])
+            return torch.stack(outputs), hidden
+
+        hx = (hidden[0].unsqueeze(0).contiguous(), hidden[1].unsqueeze(0).contiguous())
+        # same gate layout as the layer-0 weights of nn.LSTM
+        weights = {'weight_ih_l0': self.weight_ih, 'weight_hh_l0': self.weight_hh,
+                   'bias_ih_l0': self.bias_ih, 'bias_hh_l0': self.bias_hh}
+        output, (hy, cy) = functional_call(sequence_lstm(self.input_size, self.hidden_size), weights,
+                                           (input.contiguous(), hx))
+        return output, (hy.squeeze(0), cy.squeeze(0))
+
+    def cell_states(self, input, hidden, output):
+        """
+            input: [max_len, batch, input_dim]
+            hidden: (h, c) start state, each [batch, hidden_dim]
+            output: [max_len, batch, hidden_dim] from forward_sequence(input, hidden)
+
+            recover the cell state of every timestep, [max_len, batch, hidden_dim], which the fused 
+            call does not return: the gates come from the known inputs and outputs in one batched 
+            pass, leaving only the elementwise c_t = f_t * c_{t-1} + i_t * g_t recurrence
+        """
+        # [max_len, batch, hidden_dim]: h_{t-1} for every step
+        prev_output = torch.cat((hidden[0].unsqueeze(0), output[:-1]), 0)
+        gates = torch.matmul(input, self.weight_ih.t()) + torch.matmul(prev_output, self.weight_hh.t())
+        gates = gates + self.bias_ih + self.bias_hh
+        in_gate, forget_gate, cell_gate, _ = gates.chunk(4, 2)
+        in_gate = torch.sigmoid(in_gate)
+        forget_gate = torch.sigmoid(forget_gate)
+        cell_gate = torch.tanh(cell_gate)
+
+        cy = hidden[1]
+        cells = []
+        for i in range(input.size(0)):
+            cy = forget_gate[i] * cy + in_gate[i] * cell_gate[i]
+            cells.append(cy)
+        return torch.stack(cells)
+
 
 class AttentionalLSTM(nn.Module):
     """A long short-term memory (LSTM) cell with attention."""
@@ -56,34 +164,49 @@ class AttentionalLSTM(nn.Module):
         self.num_layers = 1
         self.use_attention = attention
         self.config = config
-        self.cell = nn.LSTMCell(input_dim, hidden_dim)
+        self.cell = FusedLSTMCell(input_dim, hidden_dim)
 
         if self.use_attention:
             self.attention_layer = BilinearAttention(hidden_dim)
 
 
-    def forward(self, input, hidden, ctx, srcmask):
+    def forward(self, input, hidden, ctx, srcmask, ctx_proj=None, return_cells=False):
+        """ 
+            ctx_proj: attention_layer.precompute(ctx), computed here if not given 
+            return_cells: also return the cell state of every timestep, [batch, max_len, hidden_dim]
+        """
         input = input.transpose(0, 1)
 
+        if not self.use_attention:
+            # without input feeding this is a plain lstm: run the sequence in one call
+            output, final_hidden = self.cell.forward_sequence(input, hidden)
+            if return_cells:
+                cells = self.cell.cell_states(input, hidden, output)
+                return output.transpose(0, 1), final_hidden, cells.transpose(0, 1)
+            return output.transpose(0, 1), final_hidden
+
+        if ctx_proj is None:
+            ctx_proj = self.attention_layer.precompute(ctx)
+
         output = []
+        cells = []
         timesteps = range(input.size(0))
         for i in timesteps:
             hy, cy = self.cell(input[i], hidden)
-            if self.use_attention:
-                # h_tilde: attention distribution over source seq, shape = (batch, hidden_dim)
-                # alpha: attention weights for each word in source seq, shape = (batch, max_len)
-                _, h_tilde, alpha = self.attention_layer(hy, ctx, srcmask)
-                hidden = h_tilde, cy
-                output.append(h_tilde)
-            else: 
-                hidden = hy, cy
-                output.append(hy)
+            # h_tilde: attention distribution over source seq, shape = (batch, hidden_dim)
+            # alpha: attention weights for each word in source seq, shape = (batch, max_len)
+            _, h_tilde, alpha = self.attention_layer(hy, ctx, srcmask, precomputed=ctx_proj)
+            hidden = h_tilde, cy
+            output.append(h_tilde)
+            cells.append(cy)
 
         # combine outputs, and get into [max_len, batch, hidden_dim]
         output = torch.cat(output, 0).view(input.size(0), *output[0].size())
         # [batch, max_len, hidden_dim]
         output = output.transpose(0, 1)
 
+        if return_cells:
+            return output, hidden, torch.stack(cells, 1)
         return output, hidden
 
 
@@ -103,10 +226,42 @@ class StackedAttentionLSTM(nn.Module):
             input_dim = hidden_dim
 
 
-    def forward(self, input, hidden, ctx, srcmask):
+    def precompute_attention(self, ctx):
+        """ 
+        project ctx once for every layer's attention (see BilinearAttention.precompute)
+        
+        returns a flat tuple (keys_0, values_0, keys_1, values_1, ...) for forward(ctx_proj=...), 
+        or None without attention
+        """
+        if not self.options['attention']:
+            return None
+        ctx_proj = ()
+        for layer in self.layers:
+            ctx_proj += layer.attention_layer.precompute(ctx)
+        return ctx_proj
+
+    def forward(self, input, hidden, ctx, srcmask, ctx_proj=None, return_cells=False):
+        """
+            ctx_proj: precompute_attention(ctx) (optional), reused across calls when decoding 
+                      one token at a time
+            return_cells: also return the top layer's cell state at every timestep,
+                          [batch, max_len, hidden_dim]
+            hidden: either the (h, c) start state shared by every layer, each [batch, hidden_dim],
+                    or a stacked (h, c) pair returned by a previous call, each
+                    [num_layers, batch, hidden_dim], so decoding can resume one token at a time
+        """
         h_final, c_final = [], []
         for i, layer in enumerate(self.layers):
-            output, (h_final_i, c_final_i) = layer(input, hidden, ctx, srcmask)
+            if hidden[0].dim() == 3:
+                layer_hidden = (hidden[0][i], hidden[1][i])
+            else:
+                layer_hidden = hidden
+            layer_ctx_proj = ctx_proj[2*i:2*i+2] if ctx_proj is not None else None
+            if return_cells and i == len(self.layers)-1:
+                output, (h_final_i, c_final_i), cells = layer(input, layer_hidden, ctx, srcmask, layer_ctx_proj,
+                                                              return_cells=True)
+            else:
+                output, (h_final_i, c_final_i) = layer(input, layer_hidden, ctx, srcmask, layer_ctx_proj)
             input = output     # [batch, max_len, hidden_dim]
             if i != len(self.layers)-1:
                 input = self.dropout(output)
@@ -117,4 +272,6 @@ class StackedAttentionLSTM(nn.Module):
         h_final = torch.stack(h_final)  # [num_layers, batch, hidden_dim]
         c_final = torch.stack(c_final)  # [num_layers, batch, hidden_dim]
 
+        if return_cells:
+            return input, (h_final, c_final), cells
         return input, (h_final, c_final)
\ No newline at end of file
@@ -1,6 +1,9 @@
 import math
+import random
 import numpy as np
 import sys
+import functools
+import contextlib
 from collections import Counter
 import logging
 
@@ -132,6 +135,31 @@ def rouge_2(gold_sent, decode_sent):
     return f1_score
 
 
+@contextlib.contextmanager
+def inference_context(model):
+    """ 
+    model in eval mode (no dropout) without recording an autograd graph (inference_mode where 
+    torch has it, no_grad otherwise); the model's train/eval mode is restored on exit
+    """
+    was_training = model.training
+    model.eval()
+    try:
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            yield
+    finally:
+        model.train(was_training)
+
+
+def inference(func):
+    """ decorator: run func(model, ...) in inference_context(model) """
+    @functools.wraps(func)
+    def wrapper(model, *args, **kwargs):
+        with inference_context(model):
+            return func(model, *args, **kwargs)
+    return wrapper
+
+
+@inference
 def inference_bleu(model, src, tgt, config):
     """ decode and evaluate bleu """
     searcher, rouge_list, initial_inputs, preds, ground_truths, auxs = my_decode_dataset(model, src, tgt, config)
@@ -155,6 +183,7 @@ def inference_bleu(model, src, tgt, config):
     return bleu, edit_distance, precision, recall, initial_inputs, preds, ground_truths, auxs
 
 
+@inference
 def inference_rouge(model, src, tgt, config):
     """ 
     decode and evaluate rouge
@@ -185,23 +214,46 @@ def inference_rouge(model, src, tgt, config):
     return rouge, edit_distance, precision, recall, initial_inputs, preds, ground_truths, auxs
 
 
+@inference
+def shortlist_agreement(model, src, tgt, config):
+    """ 
+    decode src with and without the vocab shortlist, returns how often they agree: 
+    (fraction of identical sentences, fraction of identical tokens position by position)
+    """
+    preds = {}
+    for use_shortlist in (False, True):
+        shortlist_config = dict(config, model=dict(config['model'], shortlist=use_shortlist))
+        _, _, _, preds[use_shortlist], _, _ = my_decode_dataset(model, src, tgt, shortlist_config)
+
+    same_sents = 0
+    same_toks, total_toks = 0, 0
+    for full, short in zip(preds[False], preds[True]):
+        same_sents += int(full == short)
+        same_toks += sum(1 for x, y in zip(full, short) if x == y)
+        total_toks += max(len(full), len(short))
+    return same_sents / float(len(preds[False])), same_toks / float(max(total_toks, 1))
 
-def evaluate_lpp(model, src, tgt, config):
+
+
+@inference
+def evaluate_lpp(model, src, tgt, config, indices=None):
     """ evaluate log perplexity WITHOUT decoding
         (i.e., with teacher forcing)
+
+        indices: only evaluate these lines (e.g. from get_dev_subset()), default all
     """
     weight_mask = torch.ones(len(tgt['tok2id']))
     if CUDA:
         weight_mask = weight_mask.cuda()
     weight_mask[tgt['tok2id']['<pad>']] = 0
-    loss_criterion = nn.CrossEntropyLoss(weight=weight_mask)
+    loss_criterion = models.SequenceLoss(weight=weight_mask, output_projection=model.output_projection)
     if CUDA:
         loss_criterion = loss_criterion.cuda()
 
     losses = []
-    for j in range(0, len(src['data']), config['data']['batch_size']):
+    for batch in dev_batches(src, config['data']['batch_size'], indices):
         # get batch
-        input_content, input_aux, output = data.minibatch(src, tgt, j, config['data']['batch_size'], 
+        input_content, input_aux, output = data.minibatch(src, tgt, batch, config['data']['batch_size'], 
                                                           config['data']['max_len'], 
                                                           config['model']['model_type'],
                                                           is_test=True)
@@ -209,121 +261,300 @@ def evaluate_lpp(model, src, tgt, config):
         input_ids_aux, _, auxlens, auxmask, _ = input_aux
         input_data_tgt, output_data_tgt, _, _, _ = output
 
-        decoder_logit, decoder_probs = model(input_content_src, srcmask, srclens,
-                                             input_ids_aux, auxmask, auxlens, input_data_tgt, mode='train')
+        decoder_logit, decoder_mixture = model(input_content_src, srcmask, srclens,
+                                               input_ids_aux, auxmask, auxlens, input_data_tgt, mode='train',
+                                               return_probs=False)
 
-        loss = loss_criterion(decoder_logit.contiguous().view(-1, len(tgt['tok2id'])),
-                              output_data_tgt.view(-1))
+        loss = loss_criterion(decoder_logit, decoder_mixture, output_data_tgt)
         losses.append(loss.item())
 
     return np.mean(losses)
 
 
-def evaluate_rouge(model, src, tgt, config):
+def build_searcher(model, config):
+    """ wrap model in the decoder named by config['model']['decode'] """
+    decode = config['model'].get('decode', 'greedy')
+    if decode == 'greedy':
+        # the decoded logits are not used, only the tokens
+        return models.GreedySearchDecoder(model, return_logits=False)
+    elif decode == 'beam':
+        return models.BeamSearchDecoder(model, beam_size=config['model'].get('beam_size', 5),
+                                        length_norm=config['model'].get('length_norm', 0.0))
+    else:
+        raise NotImplementedError('unknown decode type: %s' % decode)
+
+
+def get_shortlist_base(tgt, config):
     """ 
-    evaluate log perplexity WITH decoding
-    
-    args:
-        src: src data object (i.e. data 0, learnt by the model)
-        tgt: target data object (i.e. data 0, learnt by the model)
+    token ids in every decoding shortlist (config['model']['shortlist']): the special tokens, the 
+    shortlist_top_k most frequent words (the dict files are in frequency order) and the attribute 
+    vocabulary (tgt['attribute_vocab'], from the training data: not the attributes of the evaluated 
+    lines themselves). returns None when shortlists are off.
     """
-    weight_mask = torch.ones(len(tgt['tok2id']))
+    if not config['model'].get('shortlist', False):
+        return None
+    if config['model'].get('decode', 'greedy') != 'greedy':
+        raise NotImplementedError('vocab shortlists are only supported by greedy decoding')
+
+    tok2id = tgt['tok2id']
+    ids = set(tok2id[tok] for tok in ('<unk>', '<pad>', '<s>', '</s>'))
+    ids.update(range(min(config['model'].get('shortlist_top_k', 2000), len(tok2id))))
+    ids.update(tok2id[tok] for tok in tgt['attribute_vocab'] if tok in tok2id)
+    return ids
+
+
+def build_shortlist(shortlist_base, *batch_ids):
+    """ 
+    decoding shortlist of a batch: shortlist_base plus every token id in batch_ids (the source 
+    content and the attributes fed to the model); None if shortlist_base is None
+    """
+    if shortlist_base is None:
+        return None
+    ids = set(shortlist_base)
+    for x in batch_ids:
+        ids.update(x.data.cpu().view(-1).tolist())
+    shortlist = torch.LongTensor(sorted(ids))
     if CUDA:
-        weight_mask = weight_mask.cuda()
-    weight_mask[tgt['tok2id']['<pad>']] = 0
-        
-    searcher = models.GreedySearchDecoder(model)
+        shortlist = shortlist.cuda()
+    return shortlist
+
+
+def decode_batch(searcher, shortlist, *args):
+    """ run searcher on a batch, restricted to shortlist if there is one """
+    if shortlist is None:
+        return searcher(*args)
+    return searcher(*args, shortlist=shortlist)
+
+
+def get_decode_batch_size(config):
+    """ number of sentences decoded together at inference time """
+    return config['data'].get('decode_batch_size', config['data']['batch_size'])
+
+
+def get_decode_max_len(config):
+    """ maximum number of tokens generated per sentence """
+    return config['model'].get('decode_max_len', 20)
+
+
+def dev_batches(src, batch_size, indices=None):
+    """ batches of dev lines for data.minibatch(): start indices over all of src, or index lists of indices """
+    if indices is None:
+        return range(0, len(src['data']), batch_size)
+    return [indices[j:j + batch_size] for j in range(0, len(indices), batch_size)]
+
+
+def get_dev_subset(src, config):
+    """ 
+    fixed, seeded, length-stratified subset of src lines to evaluate on every epoch 
+    (config['training']['dev_subset_size']), or None to use all of them
+    """
+    size = config['training'].get('dev_subset_size', 0)
+    if not size or size >= len(src['data']):
+        return None
+    rng = random.Random(config['training']['random_seed'])
+    return data.stratified_sample(data.line_lengths(src['data']), size, rng=rng)
+
+
+def is_full_dev_epoch(epoch, config):
+    """ whether epoch evaluates on the full dev set: every full_dev_every epochs and the last epoch """
+    if not config['training'].get('dev_subset_size', 0):
+        return True
+    full_dev_every = config['training'].get('full_dev_every', 10)
+    return (epoch + 1) % full_dev_every == 0 or epoch == config['training']['epochs'] - 1
+
+
+@inference
+def decode_dev(model, src, tgt, config, indices=None):
+    """ 
+    greedy decode src lines (the given indices, default all) as auto-encoding
+
+    returns per-line lists (rouge-2 score, decoded sentence, gold sentence), in the order of the lines
+    """
+    searcher = build_searcher(model, config)
+    batch_size = get_decode_batch_size(config)
+    shortlist_base = get_shortlist_base(tgt, config)
 
     rouge_list = []
     decoded_results = []
-    for j in range(0, len(src['data'])):
-        # batch_size = 1
-        input_content, input_aux, output = data.minibatch(src, src, j, 1, 
+    golds = []
+    for batch in dev_batches(src, batch_size, indices):
+        input_content, input_aux, output = data.minibatch(src, src, batch, batch_size, 
                                              config['data']['max_len'], 
                                              config['model']['model_type'])
-        input_content_src, _, srclens, srcmask, _ = input_content
+        input_content_src, _, srclens, srcmask, idx = input_content
         input_ids_aux, _, auxlens, auxmask, _ = input_aux
         input_data_tgt, output_data_tgt, _, _, _ = output
         
         
-        decoder_logit, decoded_data_tgt = searcher(input_content_src, srcmask, srclens,
-                                                   input_ids_aux, auxmask, auxlens,
-                                                   20, tgt['tok2id']['<s>'])
-        decoded_sent = id2word(decoded_data_tgt, tgt)
-        gold_sent = id2word(output_data_tgt, tgt)
-        rouge = rouge_2(gold_sent, decoded_sent)
-        rouge_list.append(rouge)
-        decoded_results.append(decoded_sent)
+        shortlist = build_shortlist(shortlist_base, input_content_src, input_ids_aux)
+        decoder_logit, decoded_data_tgt = decode_batch(searcher, shortlist, 
+                                                       input_content_src, srcmask, srclens,
+                                                       input_ids_aux, auxmask, auxlens,
+                                                       get_decode_max_len(config), tgt['tok2id']['<s>'],
+                                                       tgt['tok2id']['</s>'])
+        # rows come back sorted by content length
+        batch_rouges = []
+        batch_decoded = []
+        batch_golds = []
+        for i in range(len(idx)):
+            decoded_sent = id2word(decoded_data_tgt[i:i + 1], tgt)
+            gold_sent = id2word(output_data_tgt[i:i + 1], tgt)
+            batch_rouges.append(rouge_2(gold_sent, decoded_sent))
+            batch_decoded.append(decoded_sent)
+            batch_golds.append(gold_sent)
+        rouge_list += data.unsort(batch_rouges, idx)
+        decoded_results += data.unsort(batch_decoded, idx)
+        golds += data.unsort(batch_golds, idx)
         
         #print('Source content sentence:'+gold_sent)
         #print('Decoded data sentence:'+decoded_sent)
 
+    return rouge_list, decoded_results, golds
+
+
+def evaluate_rouge(model, src, tgt, config, indices=None):
+    """ 
+    evaluate log perplexity WITH decoding
+    
+    args:
+        src: src data object (i.e. data 0, learnt by the model)
+        tgt: target data object (i.e. data 0, learnt by the model)
+        indices: only evaluate these lines, default all
+    """
+    rouge_list, decoded_results, _ = decode_dev(model, src, tgt, config, indices)
     return np.mean(rouge_list), decoded_results
 
-def my_decode_dataset(model, src, tgt, config):
-    searcher = models.GreedySearchDecoder(model)
+
+def bootstrap_interval(sentence_stats, metric, num_samples=1000, confidence=0.95, seed=0):
+    """ 
+    bootstrap confidence interval (low, high) of metric(sentence_stats), the rows of sentence_stats 
+    (one per sentence) being resampled with replacement num_samples times
+    """
+    sentence_stats = np.asarray(sentence_stats, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    n = len(sentence_stats)
+    values = [metric(sentence_stats[rng.randint(0, n, n)]) for _ in range(num_samples)]
+    tail = 100 * (1 - confidence) / 2
+    return float(np.percentile(values, tail)), float(np.percentile(values, 100 - tail))
+
+
+def evaluate_dev(model, src, tgt, config, indices=None):
+    """ 
+    decode src lines (the given indices, default all) like evaluate_rouge(), returns a dict of 
+    rouge (mean rouge-2) and bleu, each with a bootstrap 95% confidence interval (rouge_ci, bleu_ci), 
+    the decoded sentences (decoded) and the number of lines (num_sents)
+    """
+    rouge_list, decoded_results, golds = decode_dev(model, src, tgt, config, indices)
+    num_samples = config['training'].get('bootstrap_samples', 1000)
+    seed = config['training']['random_seed']
+
+    bleu_sentence_stats = [bleu_stats(pred.split(), gold.split()) for pred, gold in zip(decoded_results, golds)]
+    corpus_bleu = lambda stats: 100 * bleu(stats.sum(0))
+    return {
+        'rouge': float(np.mean(rouge_list)),
+        'rouge_ci': bootstrap_interval(rouge_list, np.mean, num_samples, seed=seed),
+        'bleu': corpus_bleu(np.array(bleu_sentence_stats, dtype=np.float64)),
+        'bleu_ci': bootstrap_interval(bleu_sentence_stats, corpus_bleu, num_samples, seed=seed),
+        'decoded': decoded_results,
+        'num_sents': len(rouge_list),
+    }
+
+
+def retrieved_attributes(batch_related_content_tgt, tgt, config):
+    """
+    attribute inputs of a batch from its retrieved examples, one list of
+    (source_content_str, target_content_str, target_att_str, idx, score) tuples per row
+    (see data.CorpusSearcher.most_similar_batch): every row gets the union of the attributes it retrieved
+
+    returns (input_ids_aux, auxlens, auxmask), each with max_len columns
+    """
+    input_ids_aux, auxlens, auxmask = [], [], []
+    for related_content_tgt in batch_related_content_tgt:
+        # Put all the retrieved attributes together
+        retrieved_attrs_set = set()
+        for single_data_tgt in related_content_tgt:
+            sp = single_data_tgt[2].split()
+            for attr in sp:
+                retrieved_attrs_set.add(attr)
+                    
+        # sorted, so the order (and the decoded output) doesn't depend on string hashing
+        retrieved_attrs = ' '.join(sorted(retrieved_attrs_set))
+        
+        # every row is padded to max_len, so the rows can be stacked as they are
+        row_ids, row_len, row_mask = word2id(retrieved_attrs, None, tgt, config['data']['max_len'])
+        input_ids_aux += row_ids
+        auxlens += row_len
+        auxmask += row_mask
+    
+    input_ids_aux = Variable(torch.LongTensor(input_ids_aux))
+    auxlens = Variable(torch.LongTensor(auxlens))
+    auxmask = Variable(torch.LongTensor(auxmask))
+        
+    if CUDA:
+        input_ids_aux = input_ids_aux.cuda()
+        auxlens = auxlens.cuda()
+        auxmask = auxmask.cuda()
+    return input_ids_aux, auxlens, auxmask
+
+
+@inference
+def my_decode_dataset(model, src, tgt, config, searcher=None):
+    """ searcher: decode with this instead of build_searcher(model, config) """
+    if searcher is None:
+        searcher = build_searcher(model, config)
+    batch_size = get_decode_batch_size(config)
+    shortlist_base = get_shortlist_base(tgt, config)
     rouge_list = []
     initial_inputs = []
     preds = []
     ground_truths = []
     auxs = []
     
-    for j in range(0, len(src['data'])):
-        if j%100 == 0:
+    for j in range(0, len(src['data']), batch_size):
+        if j % 100 < batch_size:
             logging.info('Finished decoding data: %d/%d ...'% (j, len(src['data'])))
         
-        # batch_size = 1
-        inputs, _, outputs = data.minibatch(src, tgt, j, 1, 
+        inputs, _, outputs = data.minibatch(src, tgt, j, batch_size, 
                                             config['data']['max_len'], 
                                             config['model']['model_type'], 
                                             is_test=True)
-        input_content_src, _, srclens, srcmask, _ = inputs
+        input_content_src, _, srclens, srcmask, idx = inputs
         _, output_data_tgt, tgtlens, tgtmask, _ = outputs
        
         
+        # rows of the batch are sorted by content length, idx[i] is the position of row i in the batch
         tgt_dist_measurer = tgt['dist_measurer']
-        related_content_tgt = tgt_dist_measurer.most_similar(j, n=3)   # list of n seq_str
-        # related_content_tgt = source_content_str, target_content_str, target_att_str, idx, score
-        
-        # Put all the retrieved attributes together
-        retrieved_attrs_set = set()
-        for single_data_tgt in related_content_tgt:
-            sp = single_data_tgt[2].split()
-            for attr in sp:
-                retrieved_attrs_set.add(attr)
-                    
-        retrieved_attrs = ' '.join(retrieved_attrs_set)
-        
-        input_ids_aux, auxlens, auxmask = word2id(retrieved_attrs, None, tgt, config['data']['max_len'])
-        
-        n_decoded_sents = []
-        
-        input_ids_aux = Variable(torch.LongTensor(input_ids_aux))
-        auxlens = Variable(torch.LongTensor(auxlens))
-        auxmask = Variable(torch.LongTensor(auxmask))
+        # one list of n seq_str per row
+        batch_related_content_tgt = tgt_dist_measurer.most_similar_batch([j + origin for origin in idx], n=3)
+        input_ids_aux, auxlens, auxmask = retrieved_attributes(batch_related_content_tgt, tgt, config)
             
-        if CUDA:
-            input_ids_aux = input_ids_aux.cuda()
-            auxlens = auxlens.cuda()
-            auxmask = auxmask.cuda()
-            
-        _, decoded_data_tgt = searcher(input_content_src, srcmask, srclens,
+        shortlist = build_shortlist(shortlist_base, input_content_src, input_ids_aux)
+        _, decoded_data_tgt = decode_batch(searcher, shortlist, 
+                                           input_content_src, srcmask, srclens,
                                            input_ids_aux, auxmask, auxlens,
-                                           20, tgt['tok2id']['<s>'])
+                                           get_decode_max_len(config), tgt['tok2id']['<s>'],
+                                           tgt['tok2id']['</s>'])
+        
+        batch_inputs, batch_preds, batch_truths, batch_auxs, batch_rouges = [], [], [], [], []
+        for i in range(len(idx)):
+            pred_sent = id2word(decoded_data_tgt[i:i + 1], tgt)
+            #print('Source content sentence:'+''.join(related_content_tgt[0][1]))
+            #print('Decoded data sentence:'+pred_sent)
+            input_sent = id2word(input_content_src[i:i + 1], src)
+            batch_inputs.append(input_sent.split())
+            batch_preds.append(pred_sent.split())
+            truth_sent = id2word(output_data_tgt[i:i + 1], tgt)
+            batch_truths.append(truth_sent.split())
+            aux_sent = id2word(input_ids_aux[i:i + 1], src)
+            batch_auxs.append(aux_sent.split())
+            rouge_cur = rouge_2(truth_sent, pred_sent)
+            batch_rouges.append(rouge_cur)
         
-        decode_sent = id2word(decoded_data_tgt, tgt)
-        n_decoded_sents.append(decode_sent)
-        #print('Source content sentence:'+''.join(related_content_tgt[0][1]))
-        #print('Decoded data sentence:'+n_decoded_sents[0])
-        input_sent = id2word(input_content_src, src)
-        initial_inputs.append(input_sent.split())
-        pred_sent = n_decoded_sents[0]
-        preds.append(pred_sent.split())
-        truth_sent = id2word(output_data_tgt, tgt)
-        ground_truths.append(truth_sent.split())
-        aux_sent = id2word(input_ids_aux, src)
-        auxs.append(aux_sent.split())
-        rouge_cur = rouge_2(truth_sent, pred_sent)
-        rouge_list.append(rouge_cur)
+        # restore the original sentence order
+        initial_inputs += data.unsort(batch_inputs, idx)
+        preds += data.unsort(batch_preds, idx)
+        ground_truths += data.unsort(batch_truths, idx)
+        auxs += data.unsort(batch_auxs, idx)
+        rouge_list += data.unsort(batch_rouges, idx)
     
     return searcher, rouge_list, initial_inputs, preds, ground_truths, auxs
\ No newline at end of file
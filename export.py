@@ -0,0 +1,249 @@
+"""
+export a trained model with its incremental greedy decoder as a TorchScript artifact
+
+    python export.py --config sample_config.json [--output model.ts]
+
+the artifact holds the traced encoder and decoder step plus a scripted greedy loop,
+so it runs with torch alone (no data.py / models.py / config):
+
+    vocab = {'vocab.txt': ''}
+    searcher = torch.jit.load('model.ts', _extra_files=vocab)
+    id2tok = vocab['vocab.txt'].decode('utf8').split('\\n')
+    decoded = searcher(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
+
+with the model's inputs as built by data.minibatch(..., is_test=True) and passed through as_inputs()
+(delete_retrieve: the retrieved attributes as input_attr; retrieval itself stays outside the artifact),
+and decoded being [batch, steps + 1] token ids starting with <s>. the artifact decodes the full
+vocabulary (no shortlist). after saving, it must decode the truth set exactly like the eager model.
+"""
+import json
+import logging
+import argparse
+import os
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import data
+import evaluation
+import runtime
+from train import build_model
+from utils import attempt_load_model
+from cuda import CUDA
+
+
+# decoder state entries of models.*.encode(), in the order they are flattened to
+STATE_KEYS = ('hidden', 'ctx', 'ctx_mask', 'ctx_proj', 'attr', 'attr_probs')
+
+
+def flatten_state(state):
+    """ decoder state dict -> list of tensors, following STATE_KEYS """
+    flat = []
+    for key in STATE_KEYS:
+        if key not in state:
+            continue
+        value = state[key]
+        flat += list(value) if isinstance(value, tuple) else [value]
+    return flat
+
+
+def unflatten_state(flat, like):
+    """ inverse of flatten_state(), with the layout of the state dict like """
+    state = {}
+    i = 0
+    for key in STATE_KEYS:
+        if key not in like:
+            continue
+        if isinstance(like[key], tuple):
+            state[key] = tuple(flat[i:i + len(like[key])])
+            i += len(like[key])
+        else:
+            state[key] = flat[i]
+            i += 1
+    return state
+
+
+def state_batch_dims(state):
+    """ the batch dimension of every flattened state tensor """
+    return [1 if key == 'hidden' else 0 for key in STATE_KEYS if key in state
+            for _ in (state[key] if isinstance(state[key], tuple) else [state[key]])]
+
+
+class EncodeWrapper(nn.Module):
+    """ model.encode() with the state flattened, its (h, c) stacked per decoder layer """
+    def __init__(self, model):
+        super(EncodeWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len):
+        state = self.model.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
+        # every layer starts from the same (h, c), see decoders.StackedAttentionLSTM
+        num_layers = self.model.options['dec_layers']
+        state['hidden'] = tuple(x.unsqueeze(0).repeat(num_layers, 1, 1) for x in state['hidden'])
+        return flatten_state(state)
+
+
+class PredictStepWrapper(nn.Module):
+    """ model.predict_step() on a flattened state """
+    def __init__(self, model, like):
+        super(PredictStepWrapper, self).__init__()
+        self.model = model
+        self.like = like
+
+    def forward(self, input_data, flat_state):
+        next_pred, state = self.model.predict_step(input_data, unflatten_state(flat_state, self.like))
+        return [next_pred] + flatten_state(state)
+
+
+class ExportedGreedySearch(nn.Module):
+    """
+    models.GreedySearchDecoder(model, return_logits=False) around traced encode and predict_step
+    modules, in TorchScript: early stop at end_id, finished rows are dropped from the active batch
+    """
+    def __init__(self, encode, predict_step, batch_dims, max_len, start_id, end_id):
+        super(ExportedGreedySearch, self).__init__()
+        self.encode = encode
+        self.predict_step = predict_step
+        self.batch_dims = batch_dims
+        self.max_len = max_len
+        self.start_id = start_id
+        self.end_id = end_id
+
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len):
+        state: List[torch.Tensor] = self.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
+        batch_size = input_con.size(0)
+        next_pred = torch.full([batch_size, 1], self.start_id, dtype=torch.long, device=input_con.device)
+        # [batch, max_len + 1]
+        decoded = torch.full([batch_size, self.max_len + 1], self.end_id, dtype=torch.long,
+                             device=input_con.device)
+        decoded[:, 0] = self.start_id
+        # rows of the full batch that are still decoding
+        active = torch.arange(0, batch_size, dtype=torch.long, device=input_con.device)
+
+        steps = 0
+        for i in range(self.max_len):
+            outputs: List[torch.Tensor] = self.predict_step(next_pred, state)
+            next_pred = outputs[0]
+            state = outputs[1:]
+            decoded[active, i + 1] = next_pred.squeeze(1)
+            steps = i + 1
+
+            unfinished = next_pred.squeeze(1) != self.end_id
+            if not bool(unfinished.any()):
+                break
+            if not bool(unfinished.all()):
+                keep = unfinished.nonzero().squeeze(1)
+                active = active[keep]
+                next_pred = next_pred[keep]
+                state = [x.index_select(dim, keep) for x, dim in zip(state, self.batch_dims)]
+
+        return decoded[:, :steps + 1]
+
+
+def export_model(model, example_batch, config, start_id, end_id):
+    """
+    trace model's encode() and predict_step() on example_batch (the model's six inputs) and
+    wrap them in the scripted greedy loop
+    """
+    model.eval()
+    with torch.no_grad():
+        state = model.encode(*example_batch)
+        encode = torch.jit.trace(EncodeWrapper(model), example_batch, check_trace=False)
+        flat_state = encode(*example_batch)
+        like = {key: value for key, value in state.items()}
+        start = torch.full([example_batch[0].size(0), 1], start_id, dtype=torch.long,
+                           device=example_batch[0].device)
+        predict_step = torch.jit.trace(PredictStepWrapper(model, like), (start, flat_state), check_trace=False)
+
+    searcher = ExportedGreedySearch(encode, predict_step, state_batch_dims(state),
+                                    evaluation.get_decode_max_len(config), start_id, end_id)
+    return torch.jit.script(searcher)
+
+
+class ExportedSearcher(object):
+    """ calls a loaded artifact like the searchers of evaluation.build_searcher() """
+    def __init__(self, artifact):
+        self.artifact = artifact
+
+    def __call__(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, *args, **kwargs):
+        with torch.no_grad():
+            return None, self.artifact(*as_inputs(input_con, con_mask, con_len, input_attr, attr_mask, attr_len))
+
+
+def as_inputs(*inputs):
+    """
+    the model's six inputs as the artifact takes them: the length lists of data.minibatch() become
+    LongTensors, and the delete model's missing attribute mask and lengths (never read) empty tensors
+    """
+    tensors = []
+    for x in inputs:
+        if x is None:
+            x = torch.LongTensor([])
+        elif not torch.is_tensor(x):
+            x = torch.LongTensor(x)
+        tensors.append(x)
+    return tuple(tensors)
+
+
+def export(config, working_dir, output_path):
+    src, tok_weights_dict = data.gen_train_data(src=config['data']['src'], tgt=config['data']['tgt'], config=config)
+    src_truth, tgt_truth = data.gen_dev_data(src=config['data']['src_truth'], tgt=config['data']['tgt_truth'],
+                                             tok_weights_dict=tok_weights_dict, config=config)
+
+    model = build_model(src, config)
+    model, epoch = attempt_load_model(model=model, checkpoint_dir=working_dir)
+    if CUDA:
+        model = model.cuda()
+    model.eval()
+
+    # any test batch does as an example for tracing
+    input_content, input_aux, _ = data.minibatch(src_truth, tgt_truth, 0, evaluation.get_decode_batch_size(config),
+                                                 config['data']['max_len'], config['model']['model_type'],
+                                                 is_test=True)
+    example_batch = as_inputs(input_content[0], input_content[3], input_content[2],
+                              input_aux[0], input_aux[3], input_aux[2])
+    artifact = export_model(model, example_batch, config, tgt_truth['tok2id']['<s>'], tgt_truth['tok2id']['</s>'])
+
+    id2tok = [tgt_truth['id2tok'][i] for i in range(len(tgt_truth['id2tok']))]
+    torch.jit.save(artifact, output_path, _extra_files={
+        'vocab.txt': '\n'.join(id2tok), 'config.json': json.dumps(config)})
+    logging.info('Saved %s' % output_path)
+
+    # the artifact must decode exactly like the eager model
+    _, _, _, eager_preds, _, _ = evaluation.my_decode_dataset(model, src_truth, tgt_truth, config)
+    loaded = ExportedSearcher(torch.jit.load(output_path))
+    _, _, _, exported_preds, _, _ = evaluation.my_decode_dataset(model, src_truth, tgt_truth, config,
+                                                                 searcher=loaded)
+    agreement = np.mean([x == y for x, y in zip(eager_preds, exported_preds)])
+    logging.info('exported/eager identical outputs: %f' % agreement)
+    if agreement < 1.0:
+        raise RuntimeError('exported model %s decodes differently from the eager model (%.1f%% identical outputs)'
+                           % (output_path, 100 * agreement))
+    return agreement
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="path to json config", required=True)
+    parser.add_argument("--output", help="artifact path (default: working_dir/model.ts)")
+
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+
+    working_dir = config['data']['working_dir']
+    if not os.path.exists(working_dir):
+        os.makedirs(working_dir)
+
+    # set up logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename='%s/export_log' % working_dir)
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger('').addHandler(console)
+
+    logging.info('Runtime: %s' % runtime.apply_runtime(config))
+
+    export(config, working_dir, args.output or os.path.join(working_dir, 'model.ts'))
@@ -9,6 +9,61 @@ import encoders
 from cuda import CUDA
 
 
+def build_output_projection(hidden_dim, vocab_size, options):
+    """ 
+    the decoder's output layer, chosen by options['output_layer']:
+        'softmax' (default): a full nn.Linear onto the vocab
+        'adaptive': an adaptive softmax with frequency clusters split at options['adaptive_cutoffs'];
+                    the dict files are sorted by frequency, so low ids are the frequent words
+    """
+    output_layer = options.get('output_layer', 'softmax')
+    if output_layer == 'softmax':
+        return nn.Linear(hidden_dim, vocab_size)
+    elif output_layer == 'adaptive':
+        cutoffs = [c for c in options.get('adaptive_cutoffs', [2000, 10000]) if c < vocab_size - 1]
+        return nn.AdaptiveLogSoftmaxWithLoss(hidden_dim, vocab_size, cutoffs,
+                                             div_value=options.get('adaptive_div_value', 4.0))
+    else:
+        raise NotImplementedError('unknown output layer: %s' % output_layer)
+
+
+def is_adaptive(output_projection):
+    return isinstance(output_projection, nn.AdaptiveLogSoftmaxWithLoss)
+
+
+def vocab_scores(output_projection, hidden, shortlist=None):
+    """ 
+    hidden [..., hidden_dim] -> [..., vocab_size]: logits of a full softmax layer, or the exact 
+    log-probabilities of an adaptive softmax (softmax over those gives the same distribution)
+    
+    shortlist: LongTensor of token ids (optional), only score those: [..., len(shortlist)]. 
+               a softmax layer then only projects onto the shortlisted rows of its weight.
+    """
+    if is_adaptive(output_projection):
+        log_probs = output_projection.log_prob(hidden.contiguous().view(-1, hidden.size(-1)))
+        log_probs = log_probs.view(*(tuple(hidden.size()[:-1]) + (-1,)))
+        return log_probs if shortlist is None else log_probs.index_select(-1, shortlist)
+    if shortlist is None:
+        return output_projection(hidden)
+    if not isinstance(output_projection, nn.Linear):
+        # e.g. quantized (see quantize_dynamic()), whose weight can't be sliced
+        return output_projection(hidden).index_select(-1, shortlist)
+    return F.linear(hidden, output_projection.weight.index_select(0, shortlist),
+                    output_projection.bias.index_select(0, shortlist))
+
+
+def vocab_argmax(output_projection, hidden, shortlist=None):
+    """ 
+    hidden [batch, hidden_dim] -> most likely token [batch], without the full vocab for adaptive softmax;
+    with a shortlist (LongTensor of token ids) the most likely shortlisted token
+    """
+    # predict() branches on the data, and a trace (see export.py) would keep only the branch it took
+    if shortlist is None and is_adaptive(output_projection) and not torch.jit.is_tracing():
+        return output_projection.predict(hidden)
+    pred = vocab_scores(output_projection, hidden, shortlist).max(-1)[1]
+    return pred if shortlist is None else shortlist[pred]
+
+
 class DeleteModel(nn.Module):
     def __init__(self, vocab_size, pad_id, config=None):
         super(DeleteModel, self).__init__()
@@ -36,7 +91,7 @@ class DeleteModel(nn.Module):
         
         self.decoder = decoders.StackedAttentionLSTM(config=config)
         
-        self.output_projection = nn.Linear(self.options['dec_hidden_dim'], self.vocab_size)
+        self.output_projection = build_output_projection(self.options['dec_hidden_dim'], self.vocab_size, self.options)
         self.softmax = nn.Softmax(dim=-1)
         self.init_weights()
         
@@ -45,9 +100,19 @@ class DeleteModel(nn.Module):
         self.embedding.weight.data.uniform_(-initrange, initrange)
         self.h_bridge.bias.data.fill_(0)
         self.c_bridge.bias.data.fill_(0)
-        self.output_projection.bias.data.fill_(0)
-        
-    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, input_data, mode):
+        if isinstance(self.output_projection, nn.Linear):
+            self.output_projection.bias.data.fill_(0)
+        
+    def encode(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len):
+        """ 
+        run the content encoder, attribute embedding and bridges once
+        
+        returns the decoder state dict consumed by decode_step():
+            'hidden': (h_t, c_t) decoder start state, each [batch, hidden_dim]
+            'ctx': bridged content encoder outputs, [batch, max_len, hidden_dim]
+            'ctx_mask': padding mask over ctx, [batch, max_len]
+            'ctx_proj': attention keys/values projected from ctx (only with attention)
+        """
         con_emb = self.embedding(input_con)
         con_mask = (1-con_mask).byte()
         output_con, (con_h_t, con_c_t) = self.encoder(con_emb, con_len, con_mask)
@@ -74,17 +139,66 @@ class DeleteModel(nn.Module):
         c_t = self.c_bridge(c_t)
         h_t = self.h_bridge(h_t)
         
+        state = {'hidden': (h_t, c_t), 'ctx': output_con, 'ctx_mask': con_mask}
+        if self.options['attention']:
+            # attention keys and values are projected once here, not at every decode step
+            state['ctx_proj'] = self.decoder.precompute_attention(output_con)
+        return state
+    
+    def decode_step(self, input_data, state):
+        """ 
+        feed only the newest tokens [batch, 1] through the decoder, resuming from state['hidden']
+        
+        returns (decoder_logit [batch, vocab_size], probs [batch, vocab_size], new state)
+        """
+        data_emb = self.embedding(input_data)
+        # [batch, 1, hidden_dim]
+        output_data, hidden = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                           state.get('ctx_proj'))
+        # [batch, vocab_size]
+        decoder_logit = vocab_scores(self.output_projection, output_data[:, -1])
+        probs = self.softmax(decoder_logit)
+        
+        state = dict(state, hidden=hidden)
+        return decoder_logit, probs, state
+    
+    def predict_step(self, input_data, state, shortlist=None):
+        """ 
+        like decode_step() but only returns the most likely next tokens [batch, 1] and the new state;
+        skips the softmax (and, for an adaptive softmax, the rare-word clusters where possible).
+        with a shortlist (LongTensor of token ids) only those tokens are scored.
+        """
+        data_emb = self.embedding(input_data)
+        # [batch, 1, hidden_dim]
+        output_data, hidden = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                           state.get('ctx_proj'))
+        next_pred = vocab_argmax(self.output_projection, output_data[:, -1], shortlist).unsqueeze(1)
+        
+        state = dict(state, hidden=hidden)
+        return next_pred, state
+        
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, input_data, mode,
+                return_probs=True):
+        state = self.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
+        
         data_emb = self.embedding(input_data)
         # [batch, max_len, hidden_dim]
-        output_data, (_, _) = self.decoder(data_emb, (h_t, c_t), output_con, con_mask)
+        output_data, (_, _) = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                           state.get('ctx_proj'))
+        if not return_probs and is_adaptive(self.output_projection):
+            # the adaptive softmax loss only evaluates the target words' clusters (see SequenceLoss)
+            return output_data, None
         # [batch * max_len, hidden_dim]
         output_data_reshape = output_data.contiguous().view(output_data.size()[0]*output_data.size()[1], 
                                                      output_data.size()[2])
         # [batch * max_len, vocab_size]
-        decoder_logit = self.output_projection(output_data_reshape)
+        decoder_logit = vocab_scores(self.output_projection, output_data_reshape)
         # [batch, max_len, vocab_size]
         decoder_logit = decoder_logit.view(output_data.size()[0], output_data.size()[1], 
                                            decoder_logit.size()[1])
+        if not return_probs:
+            # the loss only needs the logits (see SequenceLoss)
+            return decoder_logit, None
         # [batch, max_len, vocab_size]
         probs = self.softmax(decoder_logit)
         
@@ -128,7 +242,7 @@ class DeleteRetrieveModel(nn.Module):
         
         self.decoder = decoders.StackedAttentionLSTM(config=config)
         
-        self.output_projection = nn.Linear(self.options['dec_hidden_dim'], self.vocab_size)
+        self.output_projection = build_output_projection(self.options['dec_hidden_dim'], self.vocab_size, self.options)
         self.softmax = nn.Softmax(dim=-1)
         self.init_weights()
         
@@ -137,9 +251,19 @@ class DeleteRetrieveModel(nn.Module):
         self.embedding.weight.data.uniform_(-initrange, initrange)
         self.h_bridge.bias.data.fill_(0)
         self.c_bridge.bias.data.fill_(0)
-        self.output_projection.bias.data.fill_(0)
-        
-    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, input_data, mode):
+        if isinstance(self.output_projection, nn.Linear):
+            self.output_projection.bias.data.fill_(0)
+        
+    def encode(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len):
+        """ 
+        run the content encoder, attribute encoder and bridges once
+        
+        returns the decoder state dict consumed by decode_step():
+            'hidden': (h_t, c_t) decoder start state, each [batch, hidden_dim]
+            'ctx': bridged content encoder outputs, [batch, max_len, hidden_dim]
+            'ctx_mask': padding mask over ctx, [batch, max_len]
+            'ctx_proj': attention keys/values projected from ctx (only with attention)
+        """
         # [batch, max_len, word_dim]
         con_emb = self.embedding(input_con)
         con_mask = (1-con_mask).byte()
@@ -175,22 +299,68 @@ class DeleteRetrieveModel(nn.Module):
         c_t = self.c_bridge(c_t)
         h_t = self.h_bridge(h_t)
         
+        state = {'hidden': (h_t, c_t), 'ctx': output_con, 'ctx_mask': con_mask}
+        if self.options['attention']:
+            # attention keys and values are projected once here, not at every decode step
+            state['ctx_proj'] = self.decoder.precompute_attention(output_con)
+        return state
+    
+    def decode_step(self, input_data, state):
+        """ 
+        feed only the newest tokens [batch, 1] through the decoder, resuming from state['hidden']
+        
+        returns (decoder_logit [batch, vocab_size], probs [batch, vocab_size], new state)
+        """
+        data_emb = self.embedding(input_data)
+        # [batch, 1, hidden_dim]
+        output_data, hidden = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                           state.get('ctx_proj'))
+        # [batch, vocab_size]
+        decoder_logit = vocab_scores(self.output_projection, output_data[:, -1])
+        probs = self.softmax(decoder_logit)
+        
+        state = dict(state, hidden=hidden)
+        return decoder_logit, probs, state
+    
+    def predict_step(self, input_data, state, shortlist=None):
+        """ 
+        like decode_step() but only returns the most likely next tokens [batch, 1] and the new state;
+        skips the softmax (and, for an adaptive softmax, the rare-word clusters where possible).
+        with a shortlist (LongTensor of token ids) only those tokens are scored.
+        """
+        data_emb = self.embedding(input_data)
+        # [batch, 1, hidden_dim]
+        output_data, hidden = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                           state.get('ctx_proj'))
+        next_pred = vocab_argmax(self.output_projection, output_data[:, -1], shortlist).unsqueeze(1)
+        
+        state = dict(state, hidden=hidden)
+        return next_pred, state
+        
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, input_data, mode,
+                return_probs=True):
+        state = self.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
         
         data_emb = self.embedding(input_data)
         # [batch, max_len, hidden_dim]
-        output_data, (_, _) = self.decoder(data_emb, (h_t, c_t), output_con, con_mask)
+        output_data, (_, _) = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                           state.get('ctx_proj'))
+        if not return_probs and is_adaptive(self.output_projection):
+            # the adaptive softmax loss only evaluates the target words' clusters (see SequenceLoss)
+            return output_data, None
         # [batch * max_len, hidden_dim]
         output_data_reshape = output_data.contiguous().view(output_data.size()[0]*output_data.size()[1], 
                                                      output_data.size()[2])
         # [batch * max_len, vocab_size]
-        decoder_logit = self.output_projection(output_data_reshape)
+        decoder_logit = vocab_scores(self.output_projection, output_data_reshape)
         # [batch, max_len, vocab_size]
         decoder_logit = decoder_logit.view(output_data.size()[0], output_data.size()[1], 
                                            decoder_logit.size()[1])
+        if not return_probs:
+            # the loss only needs the logits (see SequenceLoss)
+            return decoder_logit, None
         # [batch, max_len, vocab_size]
         probs = self.softmax(decoder_logit)
-        print(decoder_logit.size())
-        print(probs.size())
         
         return decoder_logit, probs
     
@@ -236,7 +406,7 @@ class PointerModel(nn.Module):
         
         self.decoder = decoders.StackedAttentionLSTM(config=config)
         
-        self.output_projection = nn.Linear(self.options['dec_hidden_dim'], self.vocab_size)
+        self.output_projection = build_output_projection(self.options['dec_hidden_dim'], self.vocab_size, self.options)
         self.softmax = nn.Softmax(dim=-1)
         self.init_weights()
         
@@ -245,9 +415,23 @@ class PointerModel(nn.Module):
         self.embedding.weight.data.uniform_(-initrange, initrange)
         self.h_bridge.bias.data.fill_(0)
         self.c_bridge.bias.data.fill_(0)
-        self.output_projection.bias.data.fill_(0)
-        
-    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, input_data, mode):
+        if isinstance(self.output_projection, nn.Linear):
+            self.output_projection.bias.data.fill_(0)
+        
+    def encode(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, probs=True):
+        """ 
+        run the content encoder, attribute encoder and bridges once
+        
+        returns the decoder state dict consumed by decode_step():
+            'hidden': (h_t, c_t) decoder start state, each [batch, hidden_dim]
+            'ctx': bridged content encoder outputs, [batch, max_len, hidden_dim]
+            'ctx_mask': padding mask over ctx, [batch, max_len]
+            'ctx_proj': attention keys/values projected from ctx (only with attention)
+            'attr': (a_ht, a_ct) attribute encoder final state, each [batch, hidden_dim]
+            'attr_probs': attribute distribution over the vocab, [batch, vocab_size]
+        with probs=False (training) the attribute log-probabilities replace the probabilities:
+            'attr_log_probs': [batch, vocab_size]
+        """
         # [batch, max_len, word_dim]
         con_emb = self.embedding(input_con)
         con_mask = (1-con_mask).byte()
@@ -284,51 +468,105 @@ class PointerModel(nn.Module):
         c_t = self.c_bridge(c_t)
         h_t = self.h_bridge(h_t)
         
+        state = {'hidden': (h_t, c_t), 'ctx': output_con, 'ctx_mask': con_mask, 'attr': (a_ht, a_ct)}
+        # the attribute distribution does not depend on the decoded prefix
+        # [batch, vocab_size]
+        attr_logit = vocab_scores(self.output_projection, a_ht)
+        if probs:
+            state['attr_probs'] = self.softmax(attr_logit)
+        else:
+            state['attr_log_probs'] = F.log_softmax(attr_logit, dim=-1)
+        if self.options['attention']:
+            # attention keys and values are projected once here, not at every decode step
+            state['ctx_proj'] = self.decoder.precompute_attention(output_con)
+        return state
+    
+    def decode_step(self, input_data, state, shortlist=None):
+        """ 
+        feed only the newest tokens [batch, 1] through the decoder, resuming from state['hidden']
+        
+        returns (decoder_logit [batch, vocab_size], final_dist [batch, vocab_size], new state);
+        with a shortlist (LongTensor of token ids) both only cover those tokens, [batch, len(shortlist)],
+        the decoder distribution being renormalised over the shortlist
+        """
+        a_ht, a_ct = state['attr']
+        data_emb = self.embedding(input_data)
+        # [batch, 1, hidden_dim]
+        output_data, (h_t, c_t) = self.decoder(data_emb, state['hidden'], state['ctx'], state['ctx_mask'],
+                                               state.get('ctx_proj'))
+        
+        # [batch, hidden_dim] (top layer)
+        dec_dist = torch.cat((h_t[-1], c_t[-1]), 1)
+        attr_dist = torch.cat((a_ht, a_ct), 1)
+        p_gen_input = torch.cat((dec_dist, attr_dist), 1)
+        p_gen = torch.sigmoid(self.p_gen_linear(p_gen_input))
+        
+        # [batch, vocab_size]
+        decoder_logit = vocab_scores(self.output_projection, output_data[:, -1], shortlist)
+        dec_probs = self.softmax(decoder_logit)
+        attr_probs = state['attr_probs'] if shortlist is None else state['attr_probs'].index_select(1, shortlist)
+        final_dist = p_gen * dec_probs + (1-p_gen) * attr_probs
+        
+        state = dict(state, hidden=(h_t, c_t))
+        return decoder_logit, final_dist, state
+    
+    def predict_step(self, input_data, state, shortlist=None):
+        """ like decode_step() but only returns the most likely next tokens [batch, 1] and the new state """
+        _, final_dist, state = self.decode_step(input_data, state, shortlist)
+        next_pred = final_dist.max(-1)[1]
+        if shortlist is not None:
+            next_pred = shortlist[next_pred]
+        return next_pred.unsqueeze(1), state
+        
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, input_data, mode,
+                return_probs=True):
+        # the loss of the train mode without return_probs only needs the attribute log-probabilities
+        state = self.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len,
+                            probs=(mode != 'train' or return_probs))
+        h_t, c_t = state['hidden']
+        a_ht, a_ct = state['attr']
+        output_con, con_mask = state['ctx'], state['ctx_mask']
+        
         if mode == 'train':
-            decoder_logit_list = []
-            final_dist_list = []
-            for di in range(min(self.config['data']['max_len'], input_data.size()[1])):
-                y_t = input_data[:, di]
-                y_data_emb = self.embedding(y_t)
-                y_data_emb = y_data_emb.unsqueeze(dim=1)
-                # [batch, 1, hidden_dim]
-                output_data, (h_t, c_t) = self.decoder(y_data_emb, (h_t, c_t), output_con, con_mask)
-                
-                h_t = h_t.squeeze()
-                c_t = c_t.squeeze()
-                
-                dec_dist = torch.cat((h_t, c_t), 1)
-                attr_dist = torch.cat((a_ht, a_ct), 1)
-                p_gen_input = torch.cat((dec_dist, attr_dist), 1)
-                p_gen = self.p_gen_linear(p_gen_input)
-                p_gen = torch.sigmoid(p_gen)
+            input_data = input_data[:, :self.config['data']['max_len']]
+            y_data_emb = self.embedding(input_data)
+            # run the decoder over the whole sequence once; its (h, c) at every step feed p_gen
+            # [batch, max_len, hidden_dim]
+            output_data, _, cells = self.decoder(y_data_emb, (h_t, c_t), output_con, con_mask,
+                                                 state.get('ctx_proj'), return_cells=True)
             
-                # [batch, hidden_dim]
-                output_data_reshape = output_data.contiguous().view(output_data.size()[0]*output_data.size()[1], 
-                                                         output_data.size()[2])
-                # [batch, vocab_size]
-                decoder_logit = self.output_projection(output_data_reshape)
-                # [batch, vocab_size]
-                dec_probs = self.softmax(decoder_logit)
-                
-                # [batch, vocab_size]
-                attr_logit = self.output_projection(a_ht)
+            # the top layer's h at every step is its output
+            # [batch, max_len, hidden_dim*2]
+            dec_dist = torch.cat((output_data, cells), 2)
+            attr_dist = torch.cat((a_ht, a_ct), 1).unsqueeze(1).expand(-1, output_data.size(1), -1)
+            p_gen_input = torch.cat((dec_dist, attr_dist), 2)
+            # [batch, max_len, 1]
+            p_gen_logit = self.p_gen_linear(p_gen_input)
+            
+            if not return_probs:
+                # what SequenceLoss needs for the mixture, without any vocab-sized probabilities
                 # [batch, vocab_size]
-                attr_probs = self.softmax(attr_logit)
-                
-                dec_probs = p_gen * dec_probs
-                attr_probs = (1-p_gen) * attr_probs
-                final_dist = dec_probs + attr_probs
-                
-                decoder_logit_list.append(decoder_logit)
-                final_dist_list.append(final_dist)
+                attr_log_probs = state['attr_log_probs']
+                if is_adaptive(self.output_projection):
+                    return output_data, (p_gen_logit, attr_log_probs)
+                return self.output_projection(output_data), (p_gen_logit, attr_log_probs)
+            
+            # [batch, max_len, vocab_size]
+            decoder_logits = vocab_scores(self.output_projection, output_data)
+            
+            p_gen = torch.sigmoid(p_gen_logit)
+            dec_probs = self.softmax(decoder_logits)
+            
+            # the attribute distribution was computed once in encode()
+            # [batch, 1, vocab_size]
+            attr_probs = state['attr_probs'].unsqueeze(1)
             
-            decoder_logits = torch.stack(decoder_logit_list, 1)
-            final_dists = torch.stack(final_dist_list, 1)
+            final_dists = p_gen * dec_probs + (1-p_gen) * attr_probs
         else:
             y_data_emb = self.embedding(input_data)
             # [batch, hidden_dim]
-            output_data, (h_t, c_t) = self.decoder(y_data_emb, (h_t, c_t), output_con, con_mask)
+            output_data, (h_t, c_t) = self.decoder(y_data_emb, (h_t, c_t), output_con, con_mask,
+                                                   state.get('ctx_proj'))
             
             h_t = h_t.squeeze(dim=0)
             c_t = c_t.squeeze(dim=0)
@@ -339,14 +577,13 @@ class PointerModel(nn.Module):
             p_gen = torch.sigmoid(p_gen)
         
             # [batch, vocab_size]
-            decoder_logits = self.output_projection(output_data)
+            decoder_logits = vocab_scores(self.output_projection, output_data)
             # [batch, vocab_size]
             dec_probs = self.softmax(decoder_logits)
             
+            # the attribute distribution was computed once in encode()
             # [batch, vocab_size]
-            attr_logit = self.output_projection(a_ht)
-            # [batch, vocab_size]
-            attr_probs = self.softmax(attr_logit)
+            attr_probs = state['attr_probs']
             
             dec_probs = p_gen * dec_probs
             attr_probs = (1-p_gen) * attr_probs
@@ -363,17 +600,201 @@ class PointerModel(nn.Module):
         
 
 
+def quantize_dynamic(model):
+    """ 
+    int8 copy of model for cpu inference: the weights of the encoder lstms and of the linear layers
+    (bridges, output projection, p_gen) are quantized, activations are quantized on the fly.
+    the attention layers (whose weights are used directly, see BilinearAttention.precompute) and 
+    the decoder lstm cells (see decoders.FusedLSTMCell) stay fp32.
+    """
+    if CUDA:
+        raise NotImplementedError('dynamic quantization is for cpu inference')
+    quantized_modules = set()
+    for name, module in model.named_modules():
+        if 'attention_layer' in name:
+            continue
+        if type(module) in (nn.Linear, nn.LSTM):
+            quantized_modules.add(name)
+    return torch.quantization.quantize_dynamic(model, quantized_modules, dtype=torch.qint8)
+
+
+class SequenceLoss(nn.Module):
+    """ 
+    token-level loss on the outputs of a model's forward(..., mode='train', return_probs=False)
+    
+    plain models: cross entropy of decoder_logit. pointer model: negative log of the mixture 
+    p_gen * p_dec + (1 - p_gen) * p_attr, computed in log space as 
+    logsumexp(log p_gen + log p_dec, log (1 - p_gen) + log p_attr) at the target tokens only.
+    tokens are weighted by weight (0 for <pad>) and averaged like nn.CrossEntropyLoss(weight=weight).
+    
+    with an adaptive softmax output_projection, forward() hands over the decoder states instead of 
+    logits and log p_dec is taken from the target words' clusters only.
+    """
+    def __init__(self, weight, output_projection=None):
+        super(SequenceLoss, self).__init__()
+        self.cross_entropy = nn.CrossEntropyLoss(weight=weight)
+        self.output_projection = output_projection if is_adaptive(output_projection) else None
+
+    def forward(self, decoder_logit, mixture, target):
+        """
+            decoder_logit: [batch, max_len, vocab_size], or the decoder states [batch, max_len, hidden_dim]
+                           with an adaptive softmax
+            mixture: None, or the pointer model's (p_gen_logit [batch, max_len, 1], 
+                     attr_log_probs [batch, vocab_size])
+            target: [batch, max_len]
+        """
+        if mixture is None and self.output_projection is None:
+            return self.cross_entropy(decoder_logit.contiguous().view(-1, decoder_logit.size(-1)),
+                                      target.contiguous().view(-1))
+
+        target = target[:, :decoder_logit.size(1)]
+        token_weight = self.cross_entropy.weight[target]
+        # [batch, max_len]
+        log_final = self.target_log_probs(decoder_logit, target, token_weight)
+        if mixture is not None:
+            p_gen_logit, attr_log_probs = mixture
+            log_attr = attr_log_probs.gather(1, target)
+            # log sigmoid(x) and log (1 - sigmoid(x)) = log sigmoid(-x)
+            p_gen_logit = p_gen_logit.squeeze(2)
+            log_final = torch.stack((F.logsigmoid(p_gen_logit) + log_final,
+                                     F.logsigmoid(-p_gen_logit) + log_attr)).logsumexp(dim=0)
+
+        return -(log_final * token_weight).sum() / token_weight.sum()
+
+    def target_log_probs(self, decoder_logit, target, token_weight):
+        """ log p_dec of every target token, [batch, max_len] """
+        if self.output_projection is None:
+            return decoder_logit.gather(2, target.unsqueeze(2)).squeeze(2) - decoder_logit.logsumexp(dim=-1)
+
+        # padding (weight 0) is skipped
+        flat_target = target.contiguous().view(-1)
+        rows = token_weight.view(-1).nonzero().squeeze(1)
+        hidden = decoder_logit.contiguous().view(-1, decoder_logit.size(-1)).index_select(0, rows)
+        output = self.output_projection(hidden, flat_target.index_select(0, rows)).output
+        log_probs = output.new_zeros(flat_target.size(0)).index_copy(0, rows, output)
+        return log_probs.view(target.size())
+
+
+def select_state(state, index, keys=None):
+    """ 
+    keep only the batch rows given by index (a LongTensor) of a decoder state from encode()
+    
+    if keys is given only those entries are re-indexed, the rest are passed through as they are
+    """
+    selected = {}
+    for key, value in state.items():
+        if keys is not None and key not in keys:
+            selected[key] = value
+        elif key == 'hidden':
+            # [batch, hidden_dim] start state or [num_layers, batch, hidden_dim]
+            selected[key] = tuple(x.index_select(x.dim() - 2, index) for x in value)
+        elif isinstance(value, tuple):
+            selected[key] = tuple(x.index_select(0, index) for x in value)
+        else:
+            selected[key] = value.index_select(0, index)
+    return selected
+
+
+def expand_state(state, beam_size):
+    """ 
+    repeat every batch row of a decoder state from encode() beam_size times, row b * beam_size + k 
+    holding beam k of row b; done once per batch, as only 'hidden' changes after encoding
+    """
+    expanded = {}
+    for key, value in state.items():
+        if key == 'hidden':
+            expanded[key] = tuple(x.repeat_interleave(beam_size, dim=x.dim() - 2) for x in value)
+        elif isinstance(value, tuple):
+            expanded[key] = tuple(x.repeat_interleave(beam_size, dim=0) for x in value)
+        else:
+            expanded[key] = value.repeat_interleave(beam_size, dim=0)
+    return expanded
+
+
 class GreedySearchDecoder(nn.Module):
-    def __init__(self, model):
+    """ 
+    greedy decoder
+    
+    with incremental=True (default) the source is encoded once and only the newest token is fed
+    to the decoder at each step, carrying the decoder (h, c) state between steps. otherwise the 
+    full model is re-run over the whole decoded prefix at every step (slow, O(max_len^2)).
+    
+    if end_id is given, rows that emit it are dropped from the active batch and decoding stops
+    once every row has finished; finished rows are padded with end_id.
+    
+    with return_logits=False the per-step logits are not kept (None is returned in their place) 
+    and the model's predict_step() picks the next tokens, skipping the softmax. only then can a 
+    shortlist (LongTensor of token ids) be given to restrict the decoded tokens to.
+    """
+    def __init__(self, model, incremental=True, return_logits=True):
         super(GreedySearchDecoder, self).__init__()
         self.model = model
-        
-        
-    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, max_len, start_id):
-        input_data = Variable(torch.LongTensor([[start_id] for i in range(input_con.size(0))]))
+        self.incremental = incremental
+        self.return_logits = return_logits
+        
+        
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, max_len, start_id,
+                end_id=None, shortlist=None):
+        if shortlist is not None and (self.return_logits or not self.incremental):
+            raise NotImplementedError('vocab shortlists need incremental decoding with return_logits=False')
+        if max_len < 1:
+            raise ValueError('greedy decoding needs max_len >= 1, got %d' % max_len)
+        batch_size = input_con.size(0)
+        input_data = Variable(torch.LongTensor([[start_id] for i in range(batch_size)]))
         if CUDA:
             input_data = input_data.cuda()
         
+        if not self.incremental:
+            return self.decode_full(input_con, con_mask, con_len, input_attr, attr_mask, attr_len, 
+                                    max_len, input_data)
+        
+        state = self.model.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
+        next_pred = input_data
+        # [batch, max_len + 1]
+        decoded = input_data.data.new(batch_size, max_len + 1).fill_(start_id if end_id is None else end_id)
+        decoded[:, 0] = start_id
+        decoder_logits = None
+        # rows of the full batch that are still decoding
+        active = torch.arange(0, batch_size).long()
+        if CUDA:
+            active = active.cuda()
+        
+        for i in range(max_len):
+            if not self.return_logits:
+                # [active, 1]
+                next_pred, state = self.model.predict_step(next_pred, state, shortlist)
+                next_pred = next_pred.data
+            else:
+                # [active, vocab_size]
+                decoder_logit, word_prob, state = self.model.decode_step(next_pred, state)
+                if decoder_logits is None:
+                    # [batch, max_len, vocab_size]
+                    decoder_logits = decoder_logit.data.new(batch_size, max_len, decoder_logit.size(1)).zero_()
+                decoder_logits[active, i] = decoder_logit.data
+                # [active, 1]
+                next_pred = word_prob.data.max(-1)[1].unsqueeze(1)
+            decoded[active, i + 1] = next_pred.squeeze(1)
+            
+            if end_id is not None:
+                unfinished = (next_pred.squeeze(1) != end_id)
+                if not unfinished.any():
+                    break
+                if not unfinished.all():
+                    keep = unfinished.nonzero().squeeze(1)
+                    active = active[keep]
+                    next_pred = next_pred[keep]
+                    state = select_state(state, keep)
+        
+        # drop the steps skipped because every row had finished
+        input_data = Variable(decoded[:, :i + 2])
+        if not self.return_logits:
+            return None, input_data
+        decoder_logit = Variable(decoder_logits[:, :i + 1])
+        
+        return decoder_logit, input_data
+    
+    
+    def decode_full(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, max_len, input_data):
         for i in range(max_len):
             decoder_logit, word_prob = self.model(input_con, con_mask, con_len, 
                                              input_attr, attr_mask, attr_len, input_data, mode='dev')
@@ -384,3 +805,92 @@ class GreedySearchDecoder(nn.Module):
             input_data = torch.cat((input_data, next_pred.unsqueeze(1)), dim=1)
         
         return decoder_logit, input_data
+
+
+class BeamSearchDecoder(nn.Module):
+    """ 
+    beam search decoder
+    
+    all beams of all sentences are kept in one flattened [batch * beam_size] batch, row 
+    b * beam_size + k holding beam k of sentence b. the source is encoded once and the encoder 
+    outputs are repeated out to the beams once; after that only the decoder (h, c) state is reordered 
+    to follow the surviving beams, since the encoder outputs are the same for every beam of a sentence.
+    
+    the best beam of each sentence is picked by its summed log-probability divided by 
+    length ** length_norm (0 turns length normalisation off).
+    """
+    def __init__(self, model, beam_size=5, length_norm=0.0):
+        super(BeamSearchDecoder, self).__init__()
+        self.model = model
+        self.beam_size = beam_size
+        self.length_norm = length_norm
+        
+        
+    def forward(self, input_con, con_mask, con_len, input_attr, attr_mask, attr_len, max_len, start_id,
+                end_id=None):
+        """ returns (scores [batch], best decoded sequence of each sentence [batch, steps + 1]) """
+        batch_size = input_con.size(0)
+        beam_size = self.beam_size
+        
+        # offset of the first beam of each sentence in the flattened batch
+        batch_offset = torch.arange(0, batch_size).long() * beam_size
+        # all beams start out identical, so only expand the first one at the first step
+        scores = torch.zeros(batch_size, beam_size)
+        scores[:, 1:] = -float('inf')
+        scores = scores.view(-1)
+        lengths = torch.zeros(batch_size * beam_size)
+        # 1. for beams that have emitted end_id
+        finished = torch.zeros(batch_size * beam_size)
+        # [batch * beam_size, 1]
+        decoded = torch.LongTensor(batch_size * beam_size, 1).fill_(start_id)
+        if CUDA:
+            batch_offset = batch_offset.cuda()
+            scores = scores.cuda()
+            lengths = lengths.cuda()
+            finished = finished.cuda()
+            decoded = decoded.cuda()
+        
+        state = self.model.encode(input_con, con_mask, con_len, input_attr, attr_mask, attr_len)
+        # the encoder outputs are the same for every beam: expanded once, never reordered
+        state = expand_state(state, beam_size)
+        
+        for i in range(max_len):
+            _, word_prob, state = self.model.decode_step(Variable(decoded[:, -1:]), state)
+            # [batch * beam_size, vocab_size]
+            log_probs = torch.log(word_prob.data.clamp(min=1e-20))
+            vocab_size = log_probs.size(1)
+            if end_id is not None:
+                # finished beams can only be extended with end_id, at no cost
+                end_log_probs = log_probs.new(vocab_size).fill_(-1e20)
+                end_log_probs[end_id] = 0.
+                finished_rows = finished.unsqueeze(1)
+                log_probs = log_probs * (1 - finished_rows) + end_log_probs.unsqueeze(0) * finished_rows
+            
+            # [batch, beam_size * vocab_size]
+            candidates = (scores.unsqueeze(1) + log_probs).view(batch_size, -1)
+            # [batch, beam_size]
+            scores, flat_idx = candidates.topk(beam_size, dim=1)
+            scores = scores.view(-1)
+            next_tokens = (flat_idx % vocab_size).view(-1)
+            # [batch * beam_size] row of the beam that each survivor extends
+            prev_beam = (flat_idx // vocab_size + batch_offset.unsqueeze(1)).view(-1)
+            
+            decoded = torch.cat((decoded.index_select(0, prev_beam), next_tokens.unsqueeze(1)), 1)
+            finished = finished.index_select(0, prev_beam)
+            # the end token counts towards the length
+            lengths = lengths.index_select(0, prev_beam) + (1 - finished)
+            # only the decoder (h, c) follows the surviving beams
+            state = select_state(state, prev_beam, keys=('hidden',))
+            
+            if end_id is not None:
+                finished = torch.max(finished, (next_tokens == end_id).float())
+                if finished.min() > 0:
+                    break
+        
+        if self.length_norm:
+            scores = scores / lengths.clamp(min=1) ** self.length_norm
+        # [batch]
+        scores, best = scores.view(batch_size, beam_size).max(1)
+        input_data = Variable(decoded.index_select(0, best + batch_offset))
+        
+        return Variable(scores), input_data
@@ -0,0 +1,109 @@
+"""
+cpu threads and core affinity of a process, from config['runtime'] (optional):
+
+    intra_op_threads: torch threads within an op, 0 for torch's default (default: 0)
+    inter_op_threads: torch threads running independent ops, 0 for torch's default (default: 0)
+    blas_threads: threads of the numpy / scipy / sklearn blas, e.g. under data.CorpusSearcher,
+        0 for the default (default: 0)
+    pin_cores: cpu ids to pin the process to, null for no pinning (default: null);
+        data-parallel training processes each get a contiguous share of them
+
+applied by apply_runtime() at the start of train.py, test.py, server.py and export.py
+(autotune.py measures which settings are fastest)
+"""
+import os
+import logging
+
+import numpy as np
+import torch
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+DEFAULTS = {
+    'intra_op_threads': 0,
+    'inter_op_threads': 0,
+    'blas_threads': 0,
+    'pin_cores': None,
+}
+
+# read by blas libraries when they are loaded, i.e. in processes started from this one
+BLAS_ENV_VARS = ('OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def get_runtime(config):
+    """ config['runtime'] with the defaults filled in """
+    runtime = config.get('runtime', {})
+    return {key: runtime.get(key, default) for key, default in DEFAULTS.items()}
+
+
+def available_cores():
+    """ the cpu ids this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def share_cores(cores, rank, world_size):
+    """ the contiguous share of cores of data-parallel process rank """
+    share = [int(core) for core in np.array_split(cores, world_size)[rank]]
+    # more processes than cores: they double up
+    return share or [cores[rank % len(cores)]]
+
+
+def set_blas_threads(num_threads):
+    """ limit the blas libraries of this process and of the ones it starts to num_threads """
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    if threadpool_limits is None:
+        logging.warning('threadpoolctl is not installed, blas_threads only applies to child processes')
+        return
+    threadpool_limits(limits=num_threads, user_api='blas')
+
+
+def apply_runtime(config, num_threads=None, rank=0, world_size=1):
+    """
+    apply config['runtime'] to this process; num_threads (e.g. config['training']['train_threads'])
+    overrides intra_op_threads. process rank of world_size data-parallel processes gets its share
+    of the cores and, without a thread count, as many torch threads as it has cores
+
+    returns the settings in effect
+    """
+    runtime = get_runtime(config)
+
+    cores = None
+    if runtime['pin_cores'] is not None:
+        cores = list(runtime['pin_cores'])
+        if world_size > 1:
+            cores = share_cores(cores, rank, world_size)
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        else:
+            logging.warning('core pinning is not supported on this platform')
+    elif world_size > 1:
+        # the processes share the machine's cores
+        cores = share_cores(available_cores(), rank, world_size)
+
+    intra_op_threads = num_threads or runtime['intra_op_threads'] or (len(cores) if cores else 0)
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+
+    if runtime['inter_op_threads'] and runtime['inter_op_threads'] != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(runtime['inter_op_threads'])
+        except RuntimeError:
+            # torch only allows it before its first parallel work
+            logging.warning('inter_op_threads can no longer be set, keeping %d' % torch.get_num_interop_threads())
+
+    if runtime['blas_threads']:
+        set_blas_threads(runtime['blas_threads'])
+
+    return {
+        'intra_op_threads': torch.get_num_threads(),
+        'inter_op_threads': torch.get_num_interop_threads(),
+        'blas_threads': runtime['blas_threads'],
+        'pin_cores': cores if runtime['pin_cores'] is not None else None,
+    }
@@ -0,0 +1,462 @@
+"""
+long-running inference service: the model, vocab, token weights and retrieval corpus are loaded
+once, then single sentences are translated as they come in, concurrent requests being decoded
+together in micro-batches
+
+    python server.py --config sample_config.json [--host 127.0.0.1] [--port 8000]
+    python server.py --config sample_config.json --stdin
+
+http:
+    POST /translate {"text": "..."} -> {"text": "...", "output": "..."}
+                    {"texts": [...]} -> {"texts": [...], "outputs": [...]}
+    GET /stats -> queue depth, request and batch counts, latency percentiles, cache hits and misses
+stdin: one json request per line ({"text": ...}, or {"stats": true}), answered one line each in
+the same order on stdout; other fields of the request (e.g. an "id") are echoed back
+
+config['serving'] (optional):
+    max_batch_size: most sentences decoded together (default: the decode batch size)
+    max_wait_ms: longest the first request of a batch waits for others to join it (default: 10)
+    cache_size: translations kept in an lru cache, 0 for none (default: 0)
+    cache_path: json file the cache is loaded from and saved to on exit (default: not persisted)
+"""
+import json
+import hashlib
+import logging
+import argparse
+import os
+import sys
+import time
+import queue
+import threading
+import contextlib
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+import data
+import models
+import evaluation
+import runtime
+from train import build_model
+from utils import attempt_load_model, id2word
+from cuda import CUDA
+
+
+class TranslationCache(object):
+    """
+    bounded lru cache of translations, keyed on the model inputs of a sentence (see Translator.cache_key())
+
+    entries are only valid for the checkpoint_id they were decoded with (Translator appends the
+    quantization and decode_settings_id() to it): every key starts with it,
+    and a cache file saved for another checkpoint is not loaded. with a path, the cache is loaded
+    from that json file and save() writes it back
+    """
+    def __init__(self, checkpoint_id, max_size, path=None):
+        self.checkpoint_id = checkpoint_id
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def key(self, *parts):
+        """ cache key of a sentence from lists of ids """
+        return '|'.join([self.checkpoint_id] + [' '.join(str(x) for x in part) for part in parts])
+
+    def get(self, key):
+        """ the cached translation, or None on a miss """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                # least recently used first
+                self.entries.popitem(last=False)
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            saved = json.load(f)
+        if saved['checkpoint_id'] != self.checkpoint_id:
+            logging.info('Discarding translation cache %s of checkpoint %s' % (self.path, saved['checkpoint_id']))
+            return
+        with self.lock:
+            self.entries = OrderedDict(saved['entries'][-self.max_size:])
+        logging.info('Loaded %d cached translations from %s' % (len(self.entries), self.path))
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            saved = {'checkpoint_id': self.checkpoint_id, 'entries': list(self.entries.items())}
+        # write then rename, so a crash never leaves a partial file
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(saved, f)
+        os.rename(tmp_path, self.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'cache_size': len(self.entries),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_rate': self.hits / float(max(self.hits + self.misses, 1)),
+            }
+
+
+# config['model'] keys that change what the searcher outputs for the same checkpoint
+DECODE_KEYS = ('decode', 'beam_size', 'length_norm', 'decode_max_len', 'shortlist', 'shortlist_top_k')
+
+
+def decode_settings_id(config):
+    """ digest of the decode settings of config, so cached translations of other settings don't match """
+    settings = {key: config['model'].get(key) for key in DECODE_KEYS}
+    return hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf8')).hexdigest()[:8]
+
+
+def select_rows(tensors, rows):
+    """ rows (LongTensor) of every batch tensor in tensors, None entries stay None """
+    return tuple(x.index_select(0, rows) if x is not None else None for x in tensors)
+
+
+class Translator(object):
+    """
+    the decode path of test.py for raw sentences
+
+    with config['serving']['cache_size'] > 0, translations are cached in a TranslationCache
+    (saved to config['serving']['cache_path'] if given), so repeated inputs skip decoding
+    """
+    def __init__(self, config, working_dir, quantize=False):
+        self.config = config
+        src, self.tok_weights_dict = data.gen_train_data(src=config['data']['src'], tgt=config['data']['tgt'],
+                                                         config=config)
+        # the target side of the truth set is the corpus attributes are retrieved from
+        self.src, self.tgt = data.gen_dev_data(src=config['data']['src_truth'], tgt=config['data']['tgt_truth'],
+                                               tok_weights_dict=self.tok_weights_dict, config=config)
+
+        model = build_model(src, config)
+        model, self.epoch = attempt_load_model(model=model, checkpoint_dir=working_dir)
+        checkpoint_id = str(model.checkpoint_id)
+        if CUDA:
+            model = model.cuda()
+        model.eval()
+        if quantize:
+            model = models.quantize_dynamic(model)
+            # the int8 model decodes differently
+            checkpoint_id += '-int8'
+        checkpoint_id += '-' + decode_settings_id(config)
+        self.model = model
+        self.searcher = evaluation.build_searcher(model, config)
+        self.shortlist_base = evaluation.get_shortlist_base(self.tgt, config)
+
+        serving = config.get('serving', {})
+        self.cache = None
+        if serving.get('cache_size', 0) > 0:
+            self.cache = TranslationCache(checkpoint_id, serving['cache_size'], serving.get('cache_path'))
+
+    def preprocess(self, sentence):
+        """ content tokens of sentence: its attribute words removed, as in data.split_attributes() """
+        _, content, _ = data.extract_attributes(sentence.strip().split(), self.tok_weights_dict)
+        return content
+
+    def attribute_inputs(self, contents):
+        """
+        (input_ids_aux, auxlens, auxmask) for rows of content tokens: the target attribute id
+        (delete), or the attributes retrieved for each row's content
+        """
+        if self.config['model']['model_type'] == 'delete':
+            attribute_ids = Variable(torch.LongTensor([1] * len(contents)))
+            if CUDA:
+                attribute_ids = attribute_ids.cuda()
+            return attribute_ids, None, None
+
+        related = self.tgt['dist_measurer'].most_similar_queries([' '.join(x) for x in contents], n=3)
+        return evaluation.retrieved_attributes(related, self.tgt, self.config)
+
+    def cache_key(self, content, aux, i):
+        """ cache key of row i: its content token ids and attribute ids, as fed to the model """
+        unk_id = self.src['tok2id']['<unk>']
+        content_ids = [self.src['tok2id'].get(w, unk_id) for w in content[:self.config['data']['max_len']]]
+        input_ids_aux, auxlens, _ = aux
+        attribute_ids = input_ids_aux[i].view(-1).tolist()
+        if auxlens is not None:
+            attribute_ids = attribute_ids[:int(auxlens[i])]
+        return self.cache.key(content_ids, attribute_ids)
+
+    def translate_batch(self, sentences):
+        """ translate a list of sentences, returns the output sentences in the same order """
+        contents = [self.preprocess(x) for x in sentences]
+        aux = self.attribute_inputs(contents)
+        if self.cache is None:
+            return self.decode(contents, aux)
+
+        keys = [self.cache_key(content, aux, i) for i, content in enumerate(contents)]
+        preds = [self.cache.get(key) for key in keys]
+        # only the misses are decoded
+        misses = [i for i, pred in enumerate(preds) if pred is None]
+        if misses:
+            rows = torch.LongTensor(misses)
+            if CUDA:
+                rows = rows.cuda()
+            decoded = self.decode([contents[i] for i in misses], select_rows(aux, rows))
+            for i, pred in zip(misses, decoded):
+                preds[i] = pred
+                self.cache.put(keys[i], pred)
+        return preds
+
+    def decode(self, contents, aux):
+        """ decode rows of content tokens with their attribute_inputs() aux, returns the output sentences """
+        input_content_src, _, srclens, srcmask, idx = data.get_minibatch(
+            contents, self.src['tok2id'], 0, len(contents), self.config['data']['max_len'], sort=True)
+        # rows of the batch are sorted by content length, idx[i] is the position of row i in contents
+        rows = torch.LongTensor(idx)
+        if CUDA:
+            rows = rows.cuda()
+        input_ids_aux, auxlens, auxmask = select_rows(aux, rows)
+
+        shortlist = evaluation.build_shortlist(self.shortlist_base, input_content_src, input_ids_aux)
+        with evaluation.inference_context(self.model):
+            _, decoded_data_tgt = evaluation.decode_batch(self.searcher, shortlist,
+                                                          input_content_src, srcmask, srclens,
+                                                          input_ids_aux, auxmask, auxlens,
+                                                          evaluation.get_decode_max_len(self.config),
+                                                          self.tgt['tok2id']['<s>'], self.tgt['tok2id']['</s>'])
+        preds = [id2word(decoded_data_tgt[i:i + 1], self.tgt) for i in range(len(idx))]
+        return data.unsort(preds, idx)
+
+    def stats(self):
+        return self.cache.stats() if self.cache is not None else {}
+
+
+class MicroBatcher(object):
+    """
+    collect concurrent requests into batches for translate_batch(sentences), run in one worker thread
+
+    a batch is decoded once it holds max_batch_size sentences or its oldest request has waited
+    max_wait seconds; the latencies (queueing + decoding) of the last latency_window requests
+    are kept for stats(), which also includes the dict returned by extra_stats() if given
+    """
+    def __init__(self, translate_batch, max_batch_size=32, max_wait=0.01, latency_window=1000, extra_stats=None):
+        self.translate_batch = translate_batch
+        self.extra_stats = extra_stats
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=latency_window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, sentence):
+        """ queue sentence, returns a concurrent.futures.Future of its translation """
+        future = Future()
+        self.requests.put((sentence, future, time.time()))
+        return future
+
+    def translate(self, sentence):
+        return self.submit(sentence).result()
+
+    def next_batch(self):
+        # block for the first request, then take more until the batch is full or its deadline passes
+        batch = [self.requests.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                # past the deadline, only requests that are already waiting join
+                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                outputs = self.translate_batch([sentence for sentence, _, _ in batch])
+            except Exception as e:
+                logging.exception('Decoding a batch of %d failed' % len(batch))
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            done = time.time()
+            with self.lock:
+                self.latencies.extend(done - start for _, _, start in batch)
+                self.num_requests += len(batch)
+                self.num_batches += 1
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {
+                'queue_depth': self.requests.qsize(),
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'mean_batch_size': self.num_requests / float(max(self.num_batches, 1)),
+            }
+        for p in (50, 90, 99):
+            stats['latency_p%d_ms' % p] = float(np.percentile(latencies, p)) * 1000 if latencies else None
+        if self.extra_stats is not None:
+            stats.update(self.extra_stats())
+        return stats
+
+
+class TranslateServer(ThreadingHTTPServer):
+    """ one thread per connection; bursts of clients queue in the listen backlog rather than being reset """
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_handler(batcher):
+    """ http request handler class answering from batcher """
+    class TranslateHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/translate':
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8'))
+                texts = request['texts'] if 'texts' in request else [request['text']]
+                if not all(isinstance(x, str) for x in texts):
+                    raise TypeError
+            except (ValueError, KeyError, TypeError):
+                self.send_error(400, 'expected a json object with a "text" string or a "texts" list')
+                return
+
+            # every sentence is queued on its own, so it can share a batch with other requests
+            outputs = [future.result() for future in [batcher.submit(x) for x in texts]]
+            if 'texts' in request:
+                self.send_json(dict(request, outputs=outputs))
+            else:
+                self.send_json(dict(request, output=outputs[0]))
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            self.send_json(batcher.stats())
+
+        def send_json(self, obj):
+            body = json.dumps(obj).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return TranslateHandler
+
+
+def serve_stdin(batcher, stdin, stdout):
+    """
+    json-lines loop: every line is queued as soon as it is read, so lines arriving together are
+    decoded together, and a writer thread answers them in input order
+    """
+    # response callables, in input order
+    pending = queue.Queue()
+
+    def translated(request, future):
+        try:
+            return dict(request, output=future.result())
+        except Exception as e:
+            return dict(request, error=str(e))
+
+    def write_results():
+        while True:
+            respond = pending.get()
+            if respond is None:
+                return
+            stdout.write(json.dumps(respond()) + '\n')
+            stdout.flush()
+
+    writer = threading.Thread(target=write_results)
+    writer.start()
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if request.get('stats'):
+                pending.put(lambda request=request: dict(request, **batcher.stats()))
+            else:
+                future = batcher.submit(request['text'])
+                pending.put(lambda request=request, future=future: translated(request, future))
+        except (ValueError, KeyError, AttributeError):
+            error = {'error': 'expected a json object with a "text" string', 'line': line.strip()}
+            pending.put(lambda error=error: error)
+    pending.put(None)
+    writer.join()
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="path to json config", required=True)
+    parser.add_argument("--host", help="address to listen on", default='127.0.0.1')
+    parser.add_argument("--port", help="port to listen on", type=int, default=8000)
+    parser.add_argument("--stdin", help="answer json lines from stdin instead of http", action='store_true')
+    parser.add_argument("--quantize", help="serve a dynamically quantized int8 model (cpu)", action='store_true')
+
+    args = parser.parse_args()
+    config = json.load(open(args.config, 'r'))
+
+    working_dir = config['data']['working_dir']
+    if not os.path.exists(working_dir):
+        os.makedirs(working_dir)
+
+    # set up logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename='%s/server_log' % working_dir)
+    console = logging.StreamHandler(sys.stderr)
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger('').addHandler(console)
+
+    logging.info('Runtime: %s' % runtime.apply_runtime(config))
+
+    # keep stdout for the responses in --stdin mode
+    with contextlib.redirect_stdout(sys.stderr):
+        translator = Translator(config, working_dir, quantize=args.quantize)
+    serving = config.get('serving', {})
+    batcher = MicroBatcher(translator.translate_batch,
+                           max_batch_size=serving.get('max_batch_size', evaluation.get_decode_batch_size(config)),
+                           max_wait=serving.get('max_wait_ms', 10) / 1000.0,
+                           extra_stats=translator.stats)
+    logging.info('Loaded model from epoch %d' % (translator.epoch - 1))
+
+    try:
+        if args.stdin:
+            serve_stdin(batcher, sys.stdin, sys.stdout)
+        else:
+            server = TranslateServer((args.host, args.port), make_handler(batcher))
+            logging.info('Serving on http://%s:%d' % (args.host, args.port))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.server_close()
+    finally:
+        if translator.cache is not None:
+            translator.cache.save()
@@ -3,6 +3,7 @@ import numpy as np
 import logging
 import argparse
 import os
+import time
 
 import torch
 from torch.autograd import Variable
@@ -11,6 +12,7 @@ import data
 import models
 from utils import attempt_load_model, word2id, id2word
 import evaluation
+import runtime
 from cuda import CUDA
 
 
@@ -49,6 +51,7 @@ def test(config, working_dir):
     model.eval()
     logging.info('Computing model performance on validation data ...')
     
+    start = time.time()
     if args.bleu:
         cur_metric, edit_distance, precision, recall, inputs, preds, golds, auxs = evaluation.inference_bleu(
                                                         model, src_truth, tgt_truth, config)
@@ -84,12 +87,39 @@ def test(config, working_dir):
         logging.info('eval_recall: %f' % recall)
         logging.info('eval_edit_distance: %f' % edit_distance)
         logging.info('eval_rouge: %f' % cur_metric)
+    decode_time = time.time() - start
+
+    if args.quantize:
+        # the same evaluation with a dynamically quantized int8 copy of the model
+        metric_name = 'bleu' if args.bleu else 'rouge'
+        inference = evaluation.inference_bleu if args.bleu else evaluation.inference_rouge
+        quantized_model = models.quantize_dynamic(model)
+        start = time.time()
+        int8_metric, _, _, _, _, int8_preds, _, _ = inference(quantized_model, src_truth, tgt_truth, config)
+        int8_time = time.time() - start
+        with open(working_dir + '/preds.int8.%s' % epoch, 'w') as f:
+            f.write('\n'.join(int8_preds) + '\n')
+
+        logging.info('int8_%s: %f' % (metric_name, int8_metric))
+        logging.info('int8_%s_drift: %f' % (metric_name, int8_metric - cur_metric))
+        logging.info('int8_pred_agreement: %f' % np.mean([x == y for x, y in zip(preds, int8_preds)]))
+        logging.info('int8_speedup: %.2fx (%.1fs -> %.1fs)' % (decode_time / int8_time, decode_time, int8_time))
+
+    if args.shortlist_agreement:
+        # how often shortlist decoding gives the same output as the full vocab
+        sent_agreement, tok_agreement = evaluation.shortlist_agreement(model, src_truth, tgt_truth, config)
+        logging.info('shortlist_sentence_agreement: %f' % sent_agreement)
+        logging.info('shortlist_token_agreement: %f' % tok_agreement)
 
     
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", help="path to json config", required=True)
     parser.add_argument("--bleu", help="do BLEU eval", action='store_true')
+    parser.add_argument("--quantize", help="also evaluate a dynamically quantized int8 model (cpu)",
+                        action='store_true')
+    parser.add_argument("--shortlist_agreement", help="compare vocab shortlist and full vocab decoding",
+                        action='store_true')
 
     args = parser.parse_args()
     config = json.load(open(args.config, 'r'))
@@ -111,6 +141,8 @@ if __name__=='__main__':
     console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     logging.getLogger('').addHandler(console)
     
+    logging.info('Runtime: %s' % runtime.apply_runtime(config))
+
     # start training
     test(config, working_dir)
     
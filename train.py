@@ -5,16 +5,21 @@ import argparse
 import os
 import time
 import glob
+import random
+import queue
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.multiprocessing as mp
+import torch.distributed as dist
 from torch.autograd import Variable
 
 import data
 import models
 from utils import attempt_load_model, word2id, id2word
 import evaluation
+import runtime
 from cuda import CUDA
 
 
@@ -32,12 +37,224 @@ def build_model(src, config):
     return model
 
 
-def train(config, working_dir):
+def build_optimizer(model, config):
+    lr = config['training']['learning_rate']
+    if config['training']['optimizer'] == 'adam':
+        optimizer = optim.Adam(model.parameters(), lr=lr)
+    elif config['training']['optimizer'] == 'sgd':
+        optimizer = optim.SGD(model.parameters(), lr=lr)
+    elif config['training']['optimizer']=='adadelta':
+        optimizer = optim.Adadelta(model.parameters(), lr=lr)
+    else:
+        raise NotImplementedError("Learning method not recommend for task")
+    return optimizer
+
+
+def get_batches(src, config, epoch):
+    """ 
+    the training batches of an epoch: start indices of consecutive batches, or (with 
+    config['data']['bucket_batches']) index lists of length-bucketed batches, reshuffled every epoch
+    """
+    if not config['data'].get('bucket_batches', False):
+        return list(range(0, len(src['content']), config['data']['batch_size']))
+
+    lengths = [min(l, config['data']['max_len']) for l in data.line_lengths(src['data'])]
+    rng = random.Random(config['training']['random_seed'] + epoch)
+    return data.bucket_batches(lengths, config['data']['batch_size'],
+                               max_tokens=config['data'].get('max_tokens'), rng=rng)
+
+
+def shard_batches(batches, rank, world_size):
+    """ 
+    the batches of data-parallel process rank: every world_size-th batch, with the tail dropped so 
+    every process takes the same number of steps (each step all-reduces the gradients). the batches 
+    keep their corpus indices, so sample_replace() retrieval works on the full corpus in every process
+    """
+    num_steps = len(batches) // world_size
+    return batches[rank::world_size][:num_steps]
+
+
+def get_batch_loader(src, config, epoch, rank=0, world_size=1):
+    """ 
+    prefetching iterator over the (input_content, input_aux, output) minibatches of an epoch 
+    (of this process's shard_batches() when training data-parallel); each batch draws from its own 
+    seeded random.Random so the data doesn't depend on thread timing or the number of processes
+    """
+    seed = config['training']['random_seed']
+
+    def make_batch(batch_idx, batch):
+        # seeded with the batch's index in the unsharded epoch
+        rng = random.Random('%d-%d-%d' % (seed, epoch, batch_idx * world_size + rank))
+        return data.minibatch(src, src, batch, config['data']['batch_size'],
+                              config['data']['max_len'], config['model']['model_type'], rng=rng)
+
+    batches = get_batches(src, config, epoch)
+    if world_size > 1:
+        batches = shard_batches(batches, rank, world_size)
+    return data.BatchPrefetcher(make_batch, batches,
+                                num_workers=config['data'].get('prefetch_workers', 0),
+                                max_prefetch=config['data'].get('prefetch_batches', 4))
+
+
+def all_reduce_gradients(model, world_size):
+    """ average the gradients over the data-parallel processes, in one all-reduce of all of them """
+    grads = []
+    for p in model.parameters():
+        if not p.requires_grad:
+            continue
+        # e.g. adaptive softmax clusters no target of this process's batch fell in
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        grads.append(p.grad)
+    flat = torch.cat([g.view(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset: offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def evaluate_epoch(model, src_dev, tgt_dev, config, epoch):
+    """ 
+    dev loss and evaluation.evaluate_dev() metrics (without the decoded sentences) after epoch: on 
+    fixed length-stratified subsets of config['training']['dev_subset_size'] lines, except every 
+    full_dev_every epochs and after the last epoch, which use the full dev set
+    """
+    full = evaluation.is_full_dev_epoch(epoch, config)
+    lpp_indices = None if full else evaluation.get_dev_subset(tgt_dev, config)
+    rouge_indices = None if full else evaluation.get_dev_subset(src_dev, config)
+    dev_loss = evaluation.evaluate_lpp(model=model, src=tgt_dev, tgt=tgt_dev, config=config, indices=lpp_indices)
+    metrics = evaluation.evaluate_dev(model, src_dev, tgt_dev, config, indices=rouge_indices)
+    del metrics['decoded']
+    return dev_loss, metrics
+
+
+def dev_summary(epoch, dev_loss, metrics):
+    return 'EPOCH %s DEV (%d sents) LOSS: %.4f ROUGE: %.4f [%.4f, %.4f] BLEU: %.2f [%.2f, %.2f]' % (
+        epoch, metrics['num_sents'], dev_loss, metrics['rouge'], metrics['rouge_ci'][0], metrics['rouge_ci'][1],
+        metrics['bleu'], metrics['bleu_ci'][0], metrics['bleu_ci'][1])
+
+
+def eval_worker(config, jobs, results, num_threads):
+    """ 
+    background dev evaluation process: loads the dev data once, then evaluates every (epoch, state_dict) 
+    of jobs, putting (epoch, dev_loss, dev_metrics) from evaluate_epoch() on results, until it gets None
+    """
+    runtime.apply_runtime(config, num_threads=num_threads)
+    src, tok_weights_dict = data.gen_train_data(src=config['data']['src'], tgt=config['data']['tgt'], config=config)
+    src_dev, tgt_dev = data.gen_dev_data(src=config['data']['src_dev'], tgt=config['data']['tgt_dev'], 
+                                         tok_weights_dict=tok_weights_dict, config=config)
+    model = build_model(src, config)
+    if CUDA:
+        model = model.cuda()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        epoch, state_dict = job
+        model.load_state_dict(state_dict)
+        dev_loss, dev_metrics = evaluate_epoch(model, src_dev, tgt_dev, config, epoch)
+        results.put((epoch, dev_loss, dev_metrics))
+
+
+class AsyncEvaluator(object):
+    """ 
+    dev evaluation in a separate eval_worker() process (config['training']['async_eval']), so training 
+    goes on with the next epoch while the last one is evaluated
+
+    submit() hands over a cpu snapshot of the model's parameters, which is kept until its results come 
+    back: poll() returns (epoch, dev_loss, dev_metrics, state_dict) for every finished evaluation. at most 
+    max_pending snapshots are in flight, submit() waits for the oldest (and returns its results) beyond that
+    """
+    def __init__(self, config, num_threads=1, max_pending=2):
+        # spawn: forking a process that already runs torch threads (or cuda) is unsafe
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=eval_worker, args=(config, self.jobs, self.results, num_threads))
+        self.process.daemon = True
+        self.process.start()
+        self.max_pending = max_pending
+        # epoch -> state_dict under evaluation
+        self.snapshots = {}
+
+    def submit(self, epoch, model):
+        finished = []
+        while len(self.snapshots) >= self.max_pending:
+            finished += self.poll(block=True)
+        state_dict = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+        self.snapshots[epoch] = state_dict
+        self.jobs.put((epoch, state_dict))
+        return finished
+
+    def poll(self, block=False):
+        """ results of the finished evaluations, waiting for at least one if block """
+        finished = []
+        while self.snapshots:
+            wait = block and not finished
+            try:
+                epoch, dev_loss, dev_metrics = self.results.get(timeout=1) if wait else self.results.get_nowait()
+            except queue.Empty:
+                # a dead worker would never answer
+                if not self.process.is_alive():
+                    raise RuntimeError('dev evaluation process exited with code %s' % self.process.exitcode)
+                if wait:
+                    continue
+                break
+            finished.append((epoch, dev_loss, dev_metrics, self.snapshots.pop(epoch)))
+        return finished
+
+    def close(self):
+        """ wait for the outstanding evaluations, returns their results and stops the worker """
+        finished = []
+        while self.snapshots:
+            finished += self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return finished
+
+
+def checkpoint_best(finished, best_metric, working_dir):
+    """ 
+    log AsyncEvaluator results and keep the best snapshot so far as the only checkpoint, named like 
+    the ones train() saves (model.N.ckpt after N epochs of training); returns the new best metric
+    """
+    for epoch, dev_loss, dev_metrics, state_dict in finished:
+        logging.info(dev_summary(epoch, dev_loss, dev_metrics))
+        if dev_metrics['rouge'] > best_metric:
+            # rm old checkpoint
+            for ckpt_path in glob.glob(working_dir + '/model.*.ckpt'):
+                os.system("rm %s" % ckpt_path)
+            torch.save(state_dict, working_dir + '/model.%s.ckpt' % (epoch + 1))
+            best_metric = dev_metrics['rouge']
+    return best_metric
+
+
+def train(config, working_dir, rank=0, world_size=1):
+    """ 
+    train a model in working_dir; as process rank of world_size data-parallel processes (see 
+    train_distributed()) when world_size > 1, in which case rank 0 alone evaluates and writes checkpoints
+    """
+    settings = runtime.apply_runtime(config, num_threads=config['training'].get('train_threads'),
+                                     rank=rank, world_size=world_size)
+    logging.info('Runtime: %s' % settings)
     # load data
+    if world_size > 1 and rank != 0:
+        # rank 0 fills the artifact cache first, the others read from it
+        dist.barrier()
     src, tok_weights_dict = data.gen_train_data(src=config['data']['src'], tgt=config['data']['tgt'], config=config)
     src_dev, tgt_dev = data.gen_dev_data(src=config['data']['src_dev'], tgt=config['data']['tgt_dev'], 
                                          tok_weights_dict=tok_weights_dict, config=config)
+    if world_size > 1 and rank == 0:
+        dist.barrier()
     logging.info('Reading data done!')
+
+    async_eval = config['training'].get('async_eval', False) and rank == 0
+    if async_eval:
+        # started after the data is read, so the worker finds it in the artifact cache
+        evaluator = AsyncEvaluator(config, num_threads=config['training'].get('eval_threads', 1))
     
     # build model
     model = build_model(src, config)
@@ -45,11 +262,17 @@ def train(config, working_dir):
     
     # get most recent checkpoint
     model, start_epoch = attempt_load_model(model=model, checkpoint_dir=working_dir)
+    if world_size > 1:
+        # every process starts from rank 0's parameters
+        for value in model.state_dict().values():
+            dist.broadcast(value, 0)
+        # build_model() seeded every process alike: independent dropout noise per shard
+        torch.manual_seed(config['training']['random_seed'] + rank)
     
     # initialize loss criterion
     weight_mask = torch.ones(len(src['tok2id']))
     weight_mask[src['tok2id']['<pad>']] = 0
-    loss_criterion = nn.CrossEntropyLoss(weight=weight_mask)
+    loss_criterion = models.SequenceLoss(weight=weight_mask, output_projection=model.output_projection)
     
     if CUDA:
         model = model.cuda()
@@ -57,59 +280,50 @@ def train(config, working_dir):
         loss_criterion = loss_criterion.cuda()
         
     # initialize optimizer
-    if config['training']['optimizer'] == 'adam':
-        lr = config['training']['learning_rate']
-        optimizer = optim.Adam(model.parameters(), lr=lr)
-    elif config['training']['optimizer'] == 'sgd':
-        lr = config['training']['learning_rate']
-        optimizer = optim.SGD(model.parameters(), lr=lr)
-    elif config['training']['optimizer']=='adadelta':
-        lr = config['training']['learning_rate']
-        optimizer = optim.Adadelta(model.parameters(), lr=lr)
-    else:
-        raise NotImplementedError("Learning method not recommend for task")
+    optimizer = build_optimizer(model, config)
     
     
     # start training
     start_since_last_report = time.time()
     losses_since_last_report = []
+    sents_since_last_report = 0
     best_metric = 0.0
     cur_metric = 0.0    # log perplexity or BLEU
     dev_loss = 0.0
     dev_rouge = 0.0
-    num_batches = len(src['content']) // config['data']['batch_size']
 
     for epoch in range(start_epoch, config['training']['epochs']):
-        if cur_metric > best_metric:
+        if rank == 0 and not async_eval and cur_metric > best_metric:
             # rm old checkpoint
-            for ckpt_path in glob.glob(working_dir + '/model.*'):
+            for ckpt_path in glob.glob(working_dir + '/model.*.ckpt'):
                 os.system("rm %s" % ckpt_path)
             # replace with new checkpoint
             torch.save(model.state_dict(), working_dir + '/model.%s.ckpt' % epoch)
     
             best_metric = cur_metric
     
-        for i in range(0, len(src['content']), config['data']['batch_size']):
-            batch_idx = i // config['data']['batch_size']
-            
-            # generate current training data batch
-            input_content, input_aux, output = data.minibatch(src, src, i, config['data']['batch_size'],
-                                                              config['data']['max_len'], config['model']['model_type'])
+        batches = get_batch_loader(src, config, epoch, rank, world_size)
+        num_batches = len(batches)
+        for batch_idx, (input_content, input_aux, output) in enumerate(batches):
+            # current training data batch (built ahead of time by the prefetch workers)
             input_content_src, _, srclens, srcmask, _ = input_content
             input_ids_aux, _, auxlens, auxmask, _ = input_aux
             input_data_tgt, output_data_tgt, _, _, _ = output
             
             # train the model with current training data batch
-            decoder_logit, decoder_probs = model(input_content_src, srcmask, srclens,
-                                                 input_ids_aux, auxmask, auxlens, input_data_tgt, mode='train')
+            decoder_logit, decoder_mixture = model(input_content_src, srcmask, srclens,
+                                                   input_ids_aux, auxmask, auxlens, input_data_tgt, mode='train',
+                                                   return_probs=False)
             # setup the optimizer
             optimizer.zero_grad()
-            loss = loss_criterion(decoder_logit.contiguous().view(-1, len(src['tok2id'])),
-                                  output_data_tgt.view(-1))
+            loss = loss_criterion(decoder_logit, decoder_mixture, output_data_tgt)
             losses_since_last_report.append(loss.item())
+            sents_since_last_report += input_content_src.size(0)
             
             # perform backpropagation
             loss.backward()
+            if world_size > 1:
+                all_reduce_gradients(model, world_size)
             
             # clip gradients            
             _ = nn.utils.clip_grad_norm_(model.parameters(), config['training']['max_norm'])
@@ -119,27 +333,79 @@ def train(config, working_dir):
             
             # print out the training information
             if batch_idx % config['training']['batches_per_report'] == 0:
+                if async_eval:
+                    finished = evaluator.poll()
+                    best_metric = checkpoint_best(finished, best_metric, working_dir)
+                    if finished:
+                        _, dev_loss, dev_metrics, _ = finished[-1]
+                        dev_rouge = dev_metrics['rouge']
                 s = float(time.time() - start_since_last_report)
-                wps = (config['data']['batch_size'] * config['training']['batches_per_report']) / s
+                # the other processes train on as many sentences
+                wps = sents_since_last_report * world_size / s
                 avg_loss = np.mean(losses_since_last_report)
                 info = (epoch, batch_idx, num_batches, wps, avg_loss, dev_loss, dev_rouge)
                 cur_metric = dev_rouge
                 logging.info('EPOCH: %s ITER: %s/%s WPS: %.2f LOSS: %.4f DEV_LOSS: %.4f DEV_ROUGE: %.4f' % info)
                 start_since_last_report = time.time()
                 losses_since_last_report = []
+                sents_since_last_report = 0
+
+        if async_eval:
+            # evaluated in the background while the next epoch trains
+            logging.info('EPOCH %s COMPLETE. VALIDATING IN THE BACKGROUND...' % epoch)
+            best_metric = checkpoint_best(evaluator.submit(epoch, model), best_metric, working_dir)
+            continue
+        if rank != 0:
+            continue
 
         # start evaluate the model on entire dev set
         logging.info('EPOCH %s COMPLETE. VALIDATING...' % epoch)
-        model.eval()
         
-        # compute validation loss
+        # compute validation loss (evaluation switches to eval mode without autograd, then back to train mode)
         logging.info('Computing dev_loss on validation data ...')
-        dev_loss = evaluation.evaluate_lpp(model=model, src=tgt_dev, tgt=tgt_dev, config=config)
-        dev_rouge, decoded_sents = evaluation.evaluate_rouge(model=model, src=src_dev, tgt=tgt_dev, config=config)
+        dev_loss, dev_metrics = evaluate_epoch(model, src_dev, tgt_dev, config, epoch)
+        dev_rouge = dev_metrics['rouge']
+        logging.info(dev_summary(epoch, dev_loss, dev_metrics))
         logging.info('...done!')
-    
-        # switch back to train mode
-        model.train()
+
+    if async_eval:
+        logging.info('Waiting for the last dev evaluations ...')
+        best_metric = checkpoint_best(evaluator.close(), best_metric, working_dir)
+
+
+def setup_logging(working_dir, rank=0):
+    """ log to working_dir/train_log and the console; data-parallel ranks other than 0 only log warnings """
+    if rank != 0:
+        logging.basicConfig(level=logging.WARNING,
+                            format='%(asctime)s - rank ' + str(rank) + ' - %(levelname)s - %(message)s')
+        return
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename='%s/train_log' % working_dir)
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger('').addHandler(console)
+
+
+def distributed_worker(rank, config, working_dir, world_size):
+    """ data-parallel training process rank of train_distributed() """
+    # a spawned process doesn't inherit the logging setup
+    setup_logging(working_dir, rank)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % config['training'].get('dist_port', 29500),
+                            rank=rank, world_size=world_size)
+    try:
+        train(config, working_dir, rank, world_size)
+    finally:
+        dist.destroy_process_group()
+
+
+def train_distributed(config, working_dir):
+    """ 
+    train with config['training']['num_processes'] data-parallel processes on this machine, 
+    all-reducing their gradients over gloo every step
+    """
+    world_size = config['training']['num_processes']
+    mp.spawn(distributed_worker, args=(config, working_dir, world_size), nprocs=world_size)
 
     
 if __name__=='__main__':
@@ -158,15 +424,11 @@ if __name__=='__main__':
         with open(config_path, 'w') as f:
             json.dump(config, f)
     
-    # set up logging
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
-                        filename='%s/train_log' % working_dir)
-    console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
-    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    logging.getLogger('').addHandler(console)
-    
     # start training
-    train(config, working_dir)
+    if config['training'].get('num_processes', 1) > 1:
+        train_distributed(config, working_dir)
+    else:
+        setup_logging(working_dir)
+        train(config, working_dir)
     
     
\ No newline at end of file
@@ -1,5 +1,6 @@
 import glob
 import os
+import hashlib
 import torch
 
 
@@ -16,7 +17,20 @@ def get_latest_ckpt(ckpt_dir):
     return epoch, ckpt_path
 
 
+def checkpoint_id(checkpoint_path):
+    """ name + content digest of a checkpoint file, which changes whenever the checkpoint does """
+    md5 = hashlib.md5()
+    with open(checkpoint_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return '%s-%s' % (os.path.basename(checkpoint_path), md5.hexdigest()[:12])
+
+
 def attempt_load_model(model, checkpoint_dir=None, checkpoint_path=None):
+    """ 
+    load the latest checkpoint of checkpoint_dir (or checkpoint_path) into model, if there is one;
+    model.checkpoint_id is set to its checkpoint_id() (None for fresh params)
+    """
     assert checkpoint_dir or checkpoint_path
 
     if checkpoint_dir:
@@ -26,9 +40,11 @@ def attempt_load_model(model, checkpoint_dir=None, checkpoint_path=None):
 
     if checkpoint_path:
         model.load_state_dict(torch.load(checkpoint_path))
+        model.checkpoint_id = checkpoint_id(checkpoint_path)
         print('Load from %s sucessful!' % checkpoint_path)
         return model, epoch + 1
     else:
+        model.checkpoint_id = None
         return model, 0
 
 